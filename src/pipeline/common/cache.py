@@ -0,0 +1,211 @@
+import hashlib
+import inspect
+import os
+import threading
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime as dt
+from enum import Enum
+from functools import cache, wraps
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from pydantic import BaseModel, ValidationError
+
+from pipeline.common.files import atomic_write, file_fingerprint
+from pipeline.common.log import get_logger
+from pipeline.common.products import ProductHandle
+from pipeline.config.global_settings import settings
+
+# Inputs with a repr that fully describes them
+KEYABLE_SCALARS = (str, int, float, bool, Enum, dt, np.generic)
+# Other processes share the cache, so its size is measured again every this many puts even when under budget
+EVICT_CHECK_PUTS = 100
+
+# Flows toggle this (for example from ChannelReduction.use_cache) to turn the result cache on or off
+CACHE_ENABLED: ContextVar[bool] = ContextVar("cache_enabled", default=True)
+
+
+@contextmanager
+def use_result_cache(enabled: bool) -> Iterator[None]:
+    token = CACHE_ENABLED.set(enabled)
+    try:
+        yield
+    finally:
+        CACHE_ENABLED.reset(token)
+
+
+def update_hash(hasher: "hashlib._Hash", value: Any) -> None:
+    """
+    Feed a task input into the cache key.
+    Files, and arrays memory mapped from them, are keyed on their path and fingerprint rather than their contents,
+    so keying never reads the data. Anything that can't be keyed that way is rejected rather than guessed at.
+    """
+    if isinstance(value, Path):
+        hasher.update(f"path:{value}".encode())
+        if value.is_file():
+            hasher.update(f":{file_fingerprint(value)}".encode())
+    elif isinstance(value, np.memmap) and value.filename is not None:
+        hasher.update(f"memmap:{value.dtype.str}:{value.shape}:{value.offset}:".encode())
+        update_hash(hasher, Path(value.filename))
+    elif isinstance(value, BaseModel):
+        hasher.update(f"model:{type(value).__qualname__}".encode())
+        update_hash(hasher, dict(value))
+    elif isinstance(value, dict):
+        for key in sorted(value, key=str):
+            hasher.update(f"key:{key}".encode())
+            update_hash(hasher, value[key])
+    elif isinstance(value, list | tuple | set | frozenset):
+        items = sorted(value, key=repr) if isinstance(value, set | frozenset) else value
+        hasher.update(f"{type(value).__name__}:{len(items)}".encode())
+        for item in items:
+            update_hash(hasher, item)
+    elif value is None or isinstance(value, KEYABLE_SCALARS):
+        hasher.update(f"{type(value).__qualname__}:{value!r}".encode())
+    else:
+        raise TypeError(
+            f"Can't key a cached task on a {type(value).__qualname__}, pass arrays as product handles instead"
+        )
+
+
+def compute_cache_key(func: Callable, args: tuple, kwargs: dict, version: int = 0) -> str:
+    """
+    Key a call on the function's source and version, its bound parameters and the fingerprints of its inputs.
+    Only the function's own source is hashed, not that of the helpers it calls, so a change to what a cached task
+    does anywhere else has to bump its version to invalidate old results.
+    """
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(f"{func.__module__}.{func.__qualname__}:{version}".encode())
+    try:
+        hasher.update(inspect.getsource(func).encode())
+    except (OSError, TypeError):
+        pass
+    bound = inspect.signature(func).bind(*args, **kwargs)
+    bound.apply_defaults()
+    update_hash(hasher, dict(bound.arguments))
+    return hasher.hexdigest()
+
+
+class ResultCache:
+    """
+    A content addressed, on disk cache of array results with size based LRU eviction.
+    Arrays are stored as .npy files and loaded memory mapped, product handles as JSON. A hit refreshes the file's mtime,
+    and once the cache grows past max_bytes the least recently used entries are removed.
+
+    The cache's size is tracked as entries are added, so it is only listed when that passes max_bytes, or every
+    EVICT_CHECK_PUTS puts to catch what other processes have added.
+    """
+
+    def __init__(self, path: Path, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # The size of the cache when it was last measured plus what we've added since, None until first measured
+        self.estimated_bytes: int | None = None
+        self.puts_since_check = 0
+
+    def entry_path(self, key: str) -> Path:
+        return self.path / key[:2] / f"{key}.npy"
+
+    def handle_path(self, key: str) -> Path:
+        return self.path / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> np.ndarray | ProductHandle | None:
+        handle_path = self.handle_path(key)
+        if handle_path.exists():
+            try:
+                handle = ProductHandle.model_validate_json(handle_path.read_text())
+            except ValidationError:
+                return None
+            # The product itself lives in the product store, and may have since been overwritten by another run
+            if not handle.is_current():
+                return None
+            os.utime(handle_path)
+            return handle
+
+        path = self.entry_path(key)
+        try:
+            result = np.load(path, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return None
+        os.utime(path)
+        return result
+
+    def put(self, key: str, value: np.ndarray | ProductHandle) -> None:
+        path = self.handle_path(key) if isinstance(value, ProductHandle) else self.entry_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so a crash never leaves a partial entry behind
+        with atomic_write(path) as staging, open(staging, "wb") as f:
+            if isinstance(value, ProductHandle):
+                f.write(value.model_dump_json().encode())
+            else:
+                np.save(f, value)
+        size = path.stat().st_size
+        with self.lock:
+            self.puts_since_check += 1
+            if self.estimated_bytes is not None:
+                self.estimated_bytes += size
+            if (
+                self.estimated_bytes is None
+                or self.estimated_bytes > self.max_bytes
+                or self.puts_since_check >= EVICT_CHECK_PUTS
+            ):
+                self.estimated_bytes = self.evict()
+                self.puts_since_check = 0
+
+    def evict(self) -> int:
+        """
+        Remove the least recently used entries until the cache is within max_bytes. Returns the cache's size.
+        """
+        entries = [(entry.stat(), entry) for pattern in ("*/*.npy", "*/*.json") for entry in self.path.glob(pattern)]
+        total = sum(stat.st_size for stat, _ in entries)
+        if total <= self.max_bytes:
+            return total
+        for stat, entry in sorted(entries, key=lambda x: x[0].st_mtime_ns):
+            entry.unlink(missing_ok=True)
+            total -= stat.st_size
+            if total <= self.max_bytes:
+                break
+        return total
+
+
+@cache
+def result_cache(path: Path, max_bytes: int) -> ResultCache:
+    return ResultCache(path, max_bytes)
+
+
+def get_result_cache() -> ResultCache:
+    # One instance per cache location, so the size tracked for eviction carries over between calls
+    cache_path = settings.cache_path or settings.output_path / "cache"
+    return result_cache(cache_path, settings.cache_max_bytes)
+
+
+def cache_array_result(func: Callable, version: int = 0) -> Callable:
+    """
+    Skip a task when it has already been run on the same inputs, returning its cached array result.
+    Only numpy arrays and product handles are cached, for a handle just the reference is kept as the
+    product itself already lives in the product store.
+    Bump version whenever the result would change other than through the task's own source (see `compute_cache_key`).
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not CACHE_ENABLED.get():
+            return func(*args, **kwargs)
+
+        logger = get_logger()
+        cache = get_result_cache()
+        key = compute_cache_key(func, args, kwargs, version)
+        cached = cache.get(key)
+        if cached is not None:
+            logger.info(f"Using cached result for {func.__name__} ({key})")
+            return cached
+
+        result = func(*args, **kwargs)
+        if isinstance(result, np.ndarray | ProductHandle):
+            cache.put(key, result)
+        return result
+
+    return wrapper
@@ -0,0 +1,55 @@
+import os
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Self
+
+from pydantic import BaseModel
+
+
+def file_fingerprint(path: Path) -> tuple[int, int, int]:
+    """
+    A cheap fingerprint of a file from its stat, used to detect whether it has changed since it was last analysed.
+    """
+    stat = path.stat()
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def staging_path(path: Path) -> Path:
+    """
+    Where to write a file before renaming it into place. The leading underscore keeps it out of the filestore,
+    and the process and thread keep concurrent writers of the same file apart.
+    """
+    return path.with_name(f"_{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+@contextmanager
+def atomic_write(path: Path) -> Iterator[Path]:
+    """
+    Yield a staging path to write to, which is renamed over path when the block exits, so readers only ever
+    see a complete file. Nothing is left behind if the write fails.
+    """
+    staging = staging_path(path)
+    try:
+        yield staging
+        os.replace(staging, path)
+    finally:
+        staging.unlink(missing_ok=True)
+
+
+class JsonState(BaseModel):
+    """
+    State kept in a JSON file between runs, such as how far into a source has been read.
+    A missing file is the default state.
+    """
+
+    @classmethod
+    def load(cls, path: Path) -> Self:
+        if not path.exists():
+            return cls()
+        return cls.model_validate_json(path.read_text())
+
+    def save(self, path: Path) -> None:
+        with atomic_write(path) as staging:
+            staging.write_text(self.model_dump_json(indent=2))
@@ -0,0 +1,227 @@
+import json
+import os
+import resource
+import secrets
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import cache, wraps
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from pipeline.common.files import atomic_write
+from pipeline.config.global_settings import settings
+
+SPANS_FILE_NAME = "spans.otlp.jsonl"
+# ru_maxrss is in kilobytes on Linux
+MAX_RSS_UNITS = 1024
+# Exported as pipeline_run_<metric>, with a _total suffix for counters. Counters are summed over runs, while gauges
+# hold the largest value from a single run
+RUN_METRICS = [
+    ("invocations", "counter", "Number of runs"),
+    ("wall_seconds", "counter", "Wall clock time spent in runs"),
+    ("cpu_seconds", "counter", "Process CPU time used during runs"),
+    ("read_bytes", "counter", "Bytes read from storage during runs"),
+    ("written_bytes", "counter", "Bytes written to storage during runs"),
+    ("max_rss_bytes", "gauge", "The most a single run has raised the process' peak RSS by"),
+]
+
+# The (trace id, span id) of the task or flow run we're in, so nested runs are recorded as child spans
+CURRENT_SPAN: ContextVar[tuple[str, str] | None] = ContextVar("current_span", default=None)
+
+
+class ResourceUsage(BaseModel):
+    """
+    A snapshot of the process' resource usage counters.
+    CPU time and I/O are for the whole process, so include any threads a task starts (polars, numpy).
+    I/O is what reached storage, which includes pages faulted in from memory mapped files.
+    """
+
+    wall_seconds: float
+    cpu_seconds: float
+    max_rss_bytes: int
+    read_bytes: int
+    written_bytes: int
+
+    @classmethod
+    def now(cls) -> "ResourceUsage":
+        read_bytes, written_bytes = read_io_counters()
+        return cls(
+            wall_seconds=time.perf_counter(),
+            cpu_seconds=time.process_time(),
+            max_rss_bytes=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAX_RSS_UNITS,
+            read_bytes=read_bytes,
+            written_bytes=written_bytes,
+        )
+
+    def since(self, start: "ResourceUsage") -> "ResourceUsage":
+        """
+        The usage between an earlier snapshot and this one. For max RSS that is how far the peak was raised.
+        """
+        return ResourceUsage(
+            **{name: getattr(self, name) - getattr(start, name) for name in ResourceUsage.model_fields}
+        )
+
+
+def read_io_counters() -> tuple[int, int]:
+    """
+    Bytes read from and written to storage by this process, or zeros where /proc isn't available.
+    """
+    try:
+        with open("/proc/self/io", "rb") as f:
+            counters = dict(line.split(b": ") for line in f.read().splitlines())
+    except OSError:
+        return 0, 0
+    return int(counters[b"read_bytes"]), int(counters[b"write_bytes"])
+
+
+class Instrumentation:
+    """
+    Totals of the resources used by each task and flow, exported after every run to a Prometheus textfile
+    (for node_exporter's textfile collector) and as OTLP JSON spans, one export request per line, which an
+    OpenTelemetry collector can pick up with its file receiver. Nothing needs to be listening while we run.
+
+    Each process writes its own textfile, as spawned workers can't share the totals.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.totals: defaultdict[tuple[str, str, str], dict[str, float]] = defaultdict(
+            lambda: dict.fromkeys([metric for metric, _, _ in RUN_METRICS], 0)
+        )
+
+    @property
+    def textfile_path(self) -> Path:
+        return self.path / f"pipeline_{os.getpid()}.prom"
+
+    @property
+    def spans_path(self) -> Path:
+        return self.path / SPANS_FILE_NAME
+
+    def record(
+        self,
+        kind: str,
+        name: str,
+        status: str,
+        start_time_ns: int,
+        usage: ResourceUsage,
+        span: tuple[str, str],
+        parent: tuple[str, str] | None,
+    ) -> None:
+        with self.lock:
+            totals = self.totals[(kind, name, status)]
+            totals["invocations"] += 1
+            for metric, metric_type, _ in RUN_METRICS[1:]:
+                value = getattr(usage, metric)
+                totals[metric] = totals[metric] + value if metric_type == "counter" else max(totals[metric], value)
+            self.path.mkdir(parents=True, exist_ok=True)
+            self.write_textfile()
+            self.write_span(kind, name, status, start_time_ns, usage, span, parent)
+
+    def write_textfile(self) -> None:
+        lines = []
+        for metric, metric_type, description in RUN_METRICS:
+            suffix = "_total" if metric_type == "counter" else ""
+            metric_name = f"pipeline_run_{metric}{suffix}"
+            lines.append(f"# HELP {metric_name} {description}")
+            lines.append(f"# TYPE {metric_name} {metric_type}")
+            for (kind, name, status), totals in sorted(self.totals.items()):
+                labels = f'kind="{kind}",name="{name}",status="{status}",pid="{os.getpid()}"'
+                lines.append(f"{metric_name}{{{labels}}} {totals[metric]}")
+        # The collector may read at any time, so swap the file in whole
+        with atomic_write(self.textfile_path) as staging:
+            staging.write_text("\n".join(lines) + "\n")
+
+    def write_span(
+        self,
+        kind: str,
+        name: str,
+        status: str,
+        start_time_ns: int,
+        usage: ResourceUsage,
+        span: tuple[str, str],
+        parent: tuple[str, str] | None,
+    ) -> None:
+        attributes = {"pipeline.kind": kind, "process.pid": os.getpid()} | {
+            f"pipeline.{field}": getattr(usage, field) for field in ResourceUsage.model_fields
+        }
+        otlp_span = {
+            "traceId": span[0],
+            "spanId": span[1],
+            "parentSpanId": "" if parent is None else parent[1],
+            "name": name,
+            # SPAN_KIND_INTERNAL
+            "kind": 1,
+            "startTimeUnixNano": str(start_time_ns),
+            "endTimeUnixNano": str(start_time_ns + int(usage.wall_seconds * 1e9)),
+            "attributes": [{"key": key, "value": otlp_value(value)} for key, value in attributes.items()],
+            # STATUS_CODE_OK or STATUS_CODE_ERROR
+            "status": {"code": 1 if status == "ok" else 2},
+        }
+        request = {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [{"key": "service.name", "value": otlp_value(settings.service)}]},
+                    "scopeSpans": [{"scope": {"name": "pipeline"}, "spans": [otlp_span]}],
+                }
+            ]
+        }
+        # A single appended line per span, so concurrent processes don't interleave their output
+        with open(self.spans_path, "a") as f:
+            f.write(json.dumps(request, separators=(",", ":")) + "\n")
+
+
+def otlp_value(value: str | int | float) -> dict[str, str | float]:
+    if isinstance(value, str):
+        return {"stringValue": value}
+    if isinstance(value, int):
+        # OTLP JSON encodes 64 bit integers as strings
+        return {"intValue": str(value)}
+    return {"doubleValue": value}
+
+
+@cache
+def get_instrumentation(path: Path) -> Instrumentation:
+    return Instrumentation(path)
+
+
+@contextmanager
+def instrument_run(kind: str, name: str) -> Iterator[None]:
+    """
+    Measure the resources used by a run of a task or flow, recording them when it finishes.
+    """
+    parent = CURRENT_SPAN.get()
+    trace_id = secrets.token_hex(16) if parent is None else parent[0]
+    span = (trace_id, secrets.token_hex(8))
+    token = CURRENT_SPAN.set(span)
+    start_time_ns = time.time_ns()
+    start = ResourceUsage.now()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        usage = ResourceUsage.now().since(start)
+        CURRENT_SPAN.reset(token)
+        instrumentation = get_instrumentation(settings.metrics_path or settings.output_path / "metrics")
+        instrumentation.record(kind, name, status, start_time_ns, usage, span, parent)
+
+
+def instrumented(func: Callable, kind: str, name: str) -> Callable:
+    """
+    Record the wall and CPU time, peak RSS increase and I/O of every call to func, when instrumentation is turned on.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not settings.instrument:
+            return func(*args, **kwargs)
+        with instrument_run(kind, name):
+            return func(*args, **kwargs)
+
+    return wrapper
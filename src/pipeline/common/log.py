@@ -1,20 +1,21 @@
 import json
 import logging
+import random
 import sys
 import traceback
-from collections.abc import Callable
+from contextvars import ContextVar
 from datetime import timezone as tz
-from functools import partial, wraps
+from functools import partial
 from sys import stderr
 from types import FrameType
-from typing import TYPE_CHECKING, TextIO, cast
+from typing import TYPE_CHECKING, Any, TextIO, cast
 
 from loguru import logger
 from opentelemetry import trace
-from opentelemetry.trace import INVALID_SPAN, INVALID_SPAN_CONTEXT
+from opentelemetry.trace import INVALID_SPAN, INVALID_SPAN_CONTEXT, Span, SpanContext
 
 if TYPE_CHECKING:
-    from loguru import Message
+    from loguru import Message, Record
 
 LOGGERS_TO_IGNORE = [
     name
@@ -32,19 +33,23 @@ LOGGERS_TO_IGNORE += [
     "httpx._client",
 ]
 
+# Anything that isn't JSON serialisable is written as a string, rather than the record being lost
+JSON_ENCODER = json.JSONEncoder(skipkeys=True, check_circular=False, default=str)
 
-def sink_serializer(  # noqa: C901
-    service: str,
-    message: "Message",
-    file: TextIO = stderr,
-    json_format: bool = False,
-) -> None:
-    record = message.record
-    level = record["level"].name
+# The run logger made by `get_logger`, along with the task and flow run contexts it was made for
+_run_logger: ContextVar[tuple[object | None, object | None, logging.Logger] | None] = ContextVar(
+    "_run_logger", default=None
+)
+
+# Whether `configure_logging` has set up our sink in this process
+_logging_configured = False
+
+
+def simplify_record(service: str, record: "Record") -> dict[str, Any]:
     simplified = {
         "service": service,
         "time": record["time"].astimezone(tz.utc).isoformat(timespec="milliseconds"),
-        "level": level,
+        "level": record["level"].name,
         "caller": f"{record['file'].name}:{record['line']}",
         "message": record["message"],
     }
@@ -66,29 +71,60 @@ def sink_serializer(  # noqa: C901
         if isinstance(value, Exception):
             simplified[key] = str(value)
 
+    # Ensure message is the last element
+    simplified["message"] = simplified.pop("message")
+    return simplified
+
+
+def format_record(simplified: dict[str, Any], json_format: bool) -> str:
+    if json_format:
+        return JSON_ENCODER.encode(simplified)
+    return " ".join(f"{key}={value}" for key, value in simplified.items())
+
+
+def current_span() -> tuple[Span | None, SpanContext | None]:
     # This logic is taken from opentelemetry-instrumentation-logging
     # opentelemetry.instrumentation.logging.__init__.py:111
     span = trace.get_current_span()
-    if span != INVALID_SPAN:
-        ctx = span.get_span_context()
-        if ctx != INVALID_SPAN_CONTEXT:
-            # simplified["otelServiceName"] = service
-            simplified["trace_id"] = format(ctx.trace_id, "016x")
-            simplified["span_id"] = format(ctx.span_id, "032x")
+    if span == INVALID_SPAN:
+        return None, None
+    ctx = span.get_span_context()
+    return span, None if ctx == INVALID_SPAN_CONTEXT else ctx
 
-    # Ensure message is the last element
-    simplified["message"] = simplified.pop("message")
 
-    if json_format:
-        serialized = json.dumps(simplified, skipkeys=True)
-    else:
-        serialized = ""
-        for key, value in simplified.items():
-            serialized += f"{key}={value} "
+def add_span_event(span: Span, record: "Record", simplified: dict[str, Any]) -> None:
+    span.add_event("log", simplified, timestamp=int(record["time"].timestamp() * 1e9))
+
+
+def patch_span(service: str, span_events: bool, record: "Record") -> None:
+    """
+    Add the current span's ids to a record, and optionally the record to the span as an event.
+    This runs on the thread that logged, as the span is only known there, before the record is queued for the sink.
+    """
+    span, span_context = current_span()
+    if span_context is not None:
+        # Trace ids are 128 bit and span ids 64 bit, written in full as exporters do
+        record["extra"]["trace_id"] = format(span_context.trace_id, "032x")
+        record["extra"]["span_id"] = format(span_context.span_id, "016x")
+    if span_events and span is not None:
+        add_span_event(span, record, simplify_record(service, record))
+
 
-    if span != INVALID_SPAN:
-        span.add_event("log", simplified, timestamp=int(record["time"].timestamp() * 1e9))
-    print(serialized, file=file)
+def sample_record(sample_rates: dict[str, float], record: "Record") -> bool:
+    """
+    Keep only the given fraction of each level's records, for example `{"DEBUG": 0.01}` for verbose per-file logging.
+    """
+    rate = sample_rates.get(record["level"].name)
+    return rate is None or random.random() < rate
+
+
+def sink_serializer(
+    service: str,
+    message: "Message",
+    file: TextIO = stderr,
+    json_format: bool = False,
+) -> None:
+    print(format_record(simplify_record(service, message.record), json_format), file=file)
 
 
 class InterceptHandler(logging.Handler):
@@ -112,39 +148,118 @@ class InterceptHandler(logging.Handler):
             logger_with_opts.warning("Exception logging the following native logger message: {}, {!r}", safe_msg, e)
 
 
-def configure_logging(service: str) -> None:
+def configure_logging(
+    service: str,
+    json_format: bool = False,
+    span_events: bool = False,
+    sample_rates: dict[str, float] | None = None,
+    level: str | int = "DEBUG",
+) -> None:
+    """
+    Send logs through a single loguru sink, which formats and writes them from loguru's background thread.
+    Logging then only costs the caller building the record and a queue put, so hot loops never wait on the output.
+    Records below level, or sampled out, are dropped before any of that.
+    """
+    global _logging_configured
     for name in LOGGERS_TO_IGNORE:
         logga = logging.getLogger(name)
         logga.handlers = []
 
     logging.basicConfig(handlers=[InterceptHandler()], level=logging.INFO)
     logger.remove()
-    logger.add(sink=partial(sink_serializer, service, file=sys.stderr))
+    logger.configure(patcher=partial(patch_span, service, span_events))
+    logger.add(
+        sink=partial(sink_serializer, service, file=sys.stderr, json_format=json_format),
+        level=level,
+        filter=partial(sample_record, sample_rates) if sample_rates else None,
+        enqueue=True,
+    )
+    _logging_configured = True
 
 
-def get_logger() -> logging.Logger:
-    extra: dict[str, str] = {}
-    try:
-        from prefect import get_run_logger
+def setup_logging() -> None:
+    """
+    Configure logging from settings, once per process.
+    This is for entry points (flows, scripts and pool workers) to call. Getting a logger never configures logging,
+    so anything that imports the pipeline keeps its own sinks.
+    """
+    if _logging_configured:
+        return
+    # Imported here, as the config package logs through this module
+    from pipeline.config.global_settings import settings
 
-        prefect_logger = get_run_logger()
-        # TODO: remove this and use loguru later on
-        return prefect_logger  # type: ignore
-        extra = prefect_logger.extra
+    configure_logging(
+        settings.service,
+        json_format=settings.log_json,
+        span_events=settings.log_span_events,
+        sample_rates=settings.log_sample_rates,
+        level=settings.log_level,
+    )
 
-    except Exception:
+
+def current_run_contexts() -> tuple[object | None, object | None]:
+    """
+    The prefect task and flow run contexts we're in, if any. Both are plain context variable lookups.
+    """
+    # There can't be a run context if prefect hasn't been imported, so don't pay for importing it
+    context = sys.modules.get("prefect.context")
+    if context is None:
+        return None, None
+    return context.TaskRunContext.get(), context.FlowRunContext.get()
+
+
+def get_logger() -> logging.Logger:
+    """
+    The run logger when called within a prefect task or flow, and the loguru logger otherwise.
+    The run logger is only made once per run context, so this is cheap enough to call in per-file loops.
+    """
+    task_run_context, flow_run_context = current_run_contexts()
+    if task_run_context is None and flow_run_context is None:
         return logger  # type: ignore
 
-    def intercept_prefect_log(func: Callable, level: str):
-        @wraps(func)
-        def wrapper(msg, *args, **kwargs):
-            logger.bind(**extra).log(level.upper(), msg)
+    cached = _run_logger.get()
+    if cached is not None and cached[0] is task_run_context and cached[1] is flow_run_context:
+        return cached[2]
+    run_logger = make_run_logger()
+    _run_logger.set((task_run_context, flow_run_context, run_logger))
+    return run_logger
+
+
+class RunLogger(logging.LoggerAdapter):
+    """
+    Prefect's run logger for a run, with its debug records sent through our sink instead.
+    Prefect sends every record to its API as well as the console, which is too slow for the debug logging of
+    hot loops, so those only go to our queued sink, tagged with the run they came from.
+    """
+
+    def __init__(self, run_logger: logging.LoggerAdapter):
+        super().__init__(run_logger, run_logger.extra)
+        self.sink_logger = logger.bind(**(run_logger.extra or {}))
+
+    def debug(self, msg: object, *args: object, stacklevel: int = 1, **kwargs: Any) -> None:
+        self.log(logging.DEBUG, msg, *args, stacklevel=stacklevel + 1, **kwargs)
+
+    def log(
+        self,
+        level: int,
+        msg: object,
+        *args: object,
+        exc_info: Any = None,
+        extra: dict[str, Any] | None = None,
+        stacklevel: int = 1,
+        **kwargs: Any,
+    ) -> None:
+        if level >= logging.INFO:
+            self.logger.log(level, msg, *args, exc_info=exc_info, extra=extra, stacklevel=stacklevel + 1, **kwargs)
+            return
+        # A record is only built to format the message the way logging would, such as with a mapping of arguments
+        message = logging.LogRecord(self.logger.name, level, "", 0, msg, args, None).getMessage()
+        self.sink_logger.bind(**(extra or {})).opt(depth=stacklevel, exception=exc_info or None).log(
+            "DEBUG" if level == logging.DEBUG else level, "{}", message
+        )
 
-        return wrapper
 
-    # Create an intercept for the warning, error, and exception functions
-    for level in ["debug", "info", "warning", "error", "exception"]:
-        fn = getattr(prefect_logger, level)
-        setattr(prefect_logger, level, intercept_prefect_log(fn, level))
+def make_run_logger() -> logging.Logger:
+    from prefect import get_run_logger
 
-    return prefect_logger  # type: ignore
+    return RunLogger(get_run_logger())  # type: ignore
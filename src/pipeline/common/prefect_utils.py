@@ -1,17 +1,56 @@
-from collections.abc import Callable
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
 
-from prefect import Flow, flow, task
+from prefect import Flow, Task
+from prefect.cache_policies import NO_CACHE
 from prefect.client.schemas.objects import FlowRun, State
 
-# from functools import wraps
+from pipeline.common.cache import cache_array_result
+from pipeline.common.instrumentation import instrumented
+from pipeline.common.log import setup_logging
+from pipeline.common.profiling import profiled
+
 # import time
-# from pipeline.common.log import configure_logging
 # from opentelemetry.trace import SpanKind, StatusCode
 # from prefect.runtime.flow_run import get_flow_name
 
 # from prefect.client.schemas.objects import StateType
 
 
+# Set to run tasks and flows as plain function calls, where a Prefect run would be unrelated to the flow that
+# caused it, such as in a spawned worker process
+PLAIN_CALLS: ContextVar[bool] = ContextVar("plain_calls", default=False)
+
+
+@contextmanager
+def plain_calls() -> Iterator[None]:
+    """
+    Run pipeline tasks and flows as plain function calls, without Prefect tracking them, for the rest of the block.
+    Caching, instrumentation and profiling still apply.
+    """
+    token = PLAIN_CALLS.set(True)
+    try:
+        yield
+    finally:
+        PLAIN_CALLS.reset(token)
+
+
+class PipelineTask(Task):
+    def __call__(self, *args, **kwargs):
+        if PLAIN_CALLS.get():
+            return self.fn(*args, **kwargs)
+        return super().__call__(*args, **kwargs)
+
+
+class PipelineFlow(Flow):
+    def __call__(self, *args, **kwargs):
+        if PLAIN_CALLS.get():
+            return self.fn(*args, **kwargs)
+        return super().__call__(*args, **kwargs)
+
+
 def on_finish(flow: Flow, flow_run: FlowRun, state: State):
     pass
 
@@ -22,6 +61,8 @@ TASK_DEFAULT_KWARGS = {
     "log_prints": False,
     "timeout_seconds": 3600,  # An hour timeout per task
     "cache_result_in_memory": False,
+    # Prefect's own caching would hash (and so copy) large array inputs, use cache_results instead
+    "cache_policy": NO_CACHE,
 }
 
 
@@ -36,7 +77,15 @@ FLOW_DEFAULT_KWARGS = {
 }
 
 
-def pipeline_task(**kwargs):
+def pipeline_task(cache_results: bool = False, cache_version: int = 0, **kwargs):
+    """
+    Wrap a function as a prefect task with our defaults.
+    With cache_results, array results are cached on disk keyed on the task's inputs, so reruns skip unchanged tasks.
+    The key covers the task's own source but not the helpers it calls, so bump cache_version when those change.
+    With settings.instrument, the resources each run uses are recorded (see `pipeline.common.instrumentation`).
+    With settings.profile, runs are profiled (see `pipeline.common.profiling`).
+    """
+
     def decorate(func: Callable) -> Callable:
         # tracer = get_tracer(settings.service)
         # final_kwargs = {**TASK_DEFAULT_KWARGS, **kwargs}
@@ -58,15 +107,34 @@ def pipeline_task(**kwargs):
         # return wrapper
 
         final_kwargs = {**TASK_DEFAULT_KWARGS, **kwargs}
-        return task(**final_kwargs)(func)
+        if cache_results:
+            func = cache_array_result(func, cache_version)
+        name = final_kwargs.get("name") or func.__name__
+        func = instrumented(profiled(func, name), "task", name)
+        return PipelineTask(func, **final_kwargs)
 
     return decorate
 
 
+def with_logging(func: Callable) -> Callable:
+    """
+    Set up logging before a flow runs, as flows are where the pipeline is started from.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        setup_logging()
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
 def pipeline_flow(**kwargs):
     def decorate(func: Callable) -> Callable:
         final_kwargs = {**FLOW_DEFAULT_KWARGS, **kwargs}
-        return flow(**final_kwargs)(func)
+        name = final_kwargs.get("name") or func.__name__
+        func = with_logging(instrumented(profiled(func, name), "flow", name))
+        return PipelineFlow(func, **final_kwargs)
 
         # tracer = get_tracer(settings.service)
         # final_kwargs = {**FLOW_DEFAULT_KWARGS, **kwargs}
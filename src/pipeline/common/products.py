@@ -0,0 +1,114 @@
+import os
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+from pydantic import BaseModel, ValidationError
+
+from pipeline.common.files import atomic_write, file_fingerprint, staging_path
+
+# Copy arrays into the store in blocks of about this many bytes, so a store never holds a second full copy in memory
+CHUNK_BYTES = 64 * 1024**2
+
+
+class ProductHandle(BaseModel):
+    """
+    A lightweight reference to an array on disk, which is what tasks pass between each other instead of the array.
+    The array is a raw block in a file at a known offset, so both stored .npy products and unscaled FITS HDUs
+    can be memory mapped straight from where they already are.
+    """
+
+    path: Path
+    dtype: str
+    shape: tuple[int, ...]
+    offset: int = 0
+    # The file's fingerprint when the handle was made, so a handle onto a since overwritten file is caught
+    fingerprint: tuple[int, int, int] | None = None
+    metadata: dict[str, Any] = {}
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+    def is_current(self) -> bool:
+        if not self.path.is_file():
+            return False
+        return self.fingerprint is None or self.fingerprint == file_fingerprint(self.path)
+
+    def load(self) -> np.ndarray:
+        """
+        Memory map the array read only. Nothing is read from disk until the data is used.
+        """
+        assert self.is_current(), f"Product at {self.path} has changed or been removed since this handle was made"
+        return np.memmap(self.path, dtype=np.dtype(self.dtype), mode="r", offset=self.offset, shape=self.shape)
+
+
+class ProductStore(BaseModel):
+    """
+    Intermediate products for a single exposure, stored as memory mappable .npy arrays with a JSON sidecar
+    holding the handle and its metadata. Products are written in place through a memory map and committed
+    with an atomic rename, so later stages read them without any full copies being made in between.
+    """
+
+    path: Path
+
+    def array_path(self, name: str) -> Path:
+        return self.path / f"{name}.npy"
+
+    def metadata_path(self, name: str) -> Path:
+        return self.path / f"{name}.json"
+
+    def staging_path(self, name: str) -> Path:
+        return staging_path(self.array_path(name))
+
+    def allocate(self, name: str, shape: tuple[int, ...], dtype: npt.DTypeLike) -> np.memmap:
+        """
+        Create a writable, memory mapped array for a product, for a stage to write its output into directly.
+        Nothing is visible in the store until it is committed.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        return np.lib.format.open_memmap(self.staging_path(name), mode="w+", dtype=dtype, shape=shape)
+
+    def commit(self, name: str, array: np.memmap, **metadata: Any) -> ProductHandle:
+        """
+        Flush an allocated product to disk and swap it into the store.
+        """
+        array.flush()
+        path = self.array_path(name)
+        os.replace(self.staging_path(name), path)
+        handle = ProductHandle(
+            path=path,
+            dtype=array.dtype.str,
+            shape=array.shape,
+            offset=array.offset,
+            fingerprint=file_fingerprint(path),
+            metadata=metadata,
+        )
+        with atomic_write(self.metadata_path(name)) as staging:
+            staging.write_text(handle.model_dump_json(indent=2))
+        return handle
+
+    def put(self, name: str, array: np.ndarray, **metadata: Any) -> ProductHandle:
+        """
+        Store an array, copying it across in chunks of rows.
+        """
+        out = self.allocate(name, array.shape, array.dtype)
+        if array.ndim == 0:
+            out[...] = array
+        else:
+            row_bytes = max(1, array[0].nbytes)
+            step = max(1, CHUNK_BYTES // row_bytes)
+            for start in range(0, len(array), step):
+                out[start : start + step] = array[start : start + step]
+        return self.commit(name, out, **metadata)
+
+    def get(self, name: str) -> ProductHandle | None:
+        """
+        The handle for a stored product, or None when there isn't one or it is out of date.
+        """
+        try:
+            handle = ProductHandle.model_validate_json(self.metadata_path(name).read_text())
+        except (FileNotFoundError, ValidationError):
+            return None
+        return handle if handle.is_current() else None
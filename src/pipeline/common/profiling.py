@@ -0,0 +1,100 @@
+import cProfile
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from collections.abc import Callable
+from functools import wraps
+from pathlib import Path
+from types import FrameType
+
+from pipeline.common.log import get_logger
+from pipeline.config.global_settings import settings
+
+# Only one profiler can be active in a process at a time. Runs nested in a profiled run are left to the outer
+# profile, and runs on other threads while one is being profiled aren't profiled.
+PROFILER_LOCK = threading.Lock()
+
+
+def frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_qualname} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+def collapse_stack(frame: FrameType | None) -> str:
+    """
+    A stack in the collapsed format flamegraph tools read, outermost frame first and separated by semicolons.
+    """
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame).replace(";", ":"))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    """
+    Samples the stack of a single thread at a fixed interval from a background thread, counting how often each
+    stack is seen. Unlike cProfile's caller/callee totals, these are whole stacks so can be drawn as a flamegraph.
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts: Counter[str] = Counter()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profile-sampler", daemon=True)
+
+    def run(self) -> None:
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.counts[collapse_stack(frame)] += 1
+
+    def __enter__(self) -> "StackSampler":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop_event.set()
+        self.thread.join()
+
+    def write(self, path: Path) -> None:
+        path.write_text("".join(f"{stack} {count}\n" for stack, count in self.counts.most_common()))
+
+
+def should_profile(name: str) -> bool:
+    return settings.profile and (not settings.profile_tasks or name in settings.profile_tasks)
+
+
+def profiled(func: Callable, name: str) -> Callable:
+    """
+    Profile every call to func when profiling is turned on for it, with both cProfile and a stack sampler.
+    Each call writes a .pstats file and a .collapsed file of sampled stacks to the profile path.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not should_profile(name) or not PROFILER_LOCK.acquire(blocking=False):
+            return func(*args, **kwargs)
+
+        profiler = cProfile.Profile()
+        sampler = StackSampler(threading.get_ident(), settings.profile_interval_seconds)
+        try:
+            with sampler, profiler:
+                return func(*args, **kwargs)
+        finally:
+            PROFILER_LOCK.release()
+            write_profile(name, profiler, sampler)
+
+    return wrapper
+
+
+def write_profile(name: str, profiler: cProfile.Profile, sampler: StackSampler) -> None:
+    profile_path = settings.profile_path or settings.output_path / "profiles"
+    profile_path.mkdir(parents=True, exist_ok=True)
+    stem = profile_path / f"{name}-{time.time_ns()}-{os.getpid()}"
+    profiler.dump_stats(stem.with_suffix(".pstats"))
+    sampler.write(stem.with_suffix(".collapsed"))
+    get_logger().info(f"Wrote profile of {name} to {stem}.pstats and .collapsed")
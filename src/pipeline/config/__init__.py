@@ -1,5 +1,7 @@
 from pipeline.config.reduce_channel_exposure import ChannelReduction
+from pipeline.config.reduce_night import NightReduction
 
 __all__ = [
     "ChannelReduction",
+    "NightReduction",
 ]
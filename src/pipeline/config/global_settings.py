@@ -1,12 +1,49 @@
 from pathlib import Path
+from typing import Annotated
 
-from pydantic import Field
-from pydantic_settings import BaseSettings
+from pydantic import Field, field_validator
+from pydantic_settings import BaseSettings, NoDecode
 
 
 class Settings(BaseSettings):
+    service: str = Field(default="snifs-pipeline", description="Service name logs, spans and metrics are tagged with")
+    log_level: str = Field(default="INFO", description="Lowest level of log record that is written")
+    log_json: bool = Field(default=False, description="Write log records as JSON lines rather than key=value pairs")
+    log_span_events: bool = Field(default=False, description="Also add log records to the current span as events")
+    log_sample_rates: dict[str, float] = Field(
+        default={}, description='Fraction of records kept per level, for example {"DEBUG": 0.01}'
+    )
     data_path: Path = Field(default_factory=lambda: Path(__file__).parents[3] / "data")
     output_path: Path = Field(default_factory=lambda: Path(__file__).parents[3] / "output")
+    cache_path: Path | None = Field(default=None, description="Task result cache location, defaults to output/cache")
+    cache_max_bytes: int = Field(default=10 * 1024**3, description="Size the task result cache is pruned back to")
+    partition_file_store: bool = Field(default=False, description="Store the filestore partitioned by type and run_id")
+    cfht_weather_source: str = Field(
+        default="http://mkwc.ifa.hawaii.edu/archive/wx/cfht/cfht-wx.{year}.dat",
+        description="Where to fetch a year of CFHT weather from, either a URL or a local file path",
+    )
+    instrument: bool = Field(
+        default=False, description="Record the time, CPU, memory and I/O used by every task and flow"
+    )
+    metrics_path: Path | None = Field(
+        default=None, description="Where instrumentation is written, defaults to output/metrics"
+    )
+    profile: bool = Field(default=False, description="Profile tasks and flows, writing pstats and collapsed stacks")
+    profile_tasks: Annotated[list[str], NoDecode] = Field(
+        default=[], description="Only profile the tasks and flows with these (comma separated) names, or all if empty"
+    )
+    profile_interval_seconds: float = Field(default=0.005, gt=0, description="How often profiled stacks are sampled")
+    profile_path: Path | None = Field(
+        default=None, description="Where profiles are written, defaults to output/profiles"
+    )
+    filestore_workers: int = Field(default=1, ge=1, description="Number of processes used to extract file headers")
+
+    @field_validator("profile_tasks", mode="before")
+    @classmethod
+    def split_profile_tasks(cls, v: str | list[str]) -> list[str]:
+        if isinstance(v, str):
+            return [name.strip() for name in v.split(",") if name.strip()]
+        return v
 
 
 settings = Settings()
@@ -13,14 +13,14 @@ class ChannelReduction(BaseSettings):
         description="Location of the science file. This is actual observation. Relative to the data path."
     )
 
-    arc_file: FilePath = Field(
+    arc_file: FilePath | None = Field(
         default=None,
         description="Location of the arc file(s). For a single exposure, the arc is usually taken "
         "immediately after the science exposure."
         "For two exposures, the arc is usually in the middle.",
-    )  # type: ignore
+    )
 
-    weather_file: FilePath = Field(default=None, description="Location of the weather file")  # type: ignore
+    weather_file: FilePath | None = Field(default=None, description="Location of the weather file")
 
     continuum_files: list[FilePath] = Field(
         default=[],
@@ -58,5 +58,32 @@ class ChannelReduction(BaseSettings):
             self.continuum_files = resolver.get_match_paths("FLAT", primary)
         if self.weather_file is None:
             self.weather_file = resolver.get_match_path("WEATHER", primary)
+        if self.detector_last_on_time is None:
+            last_on_times = resolver.get_detector_last_on_times([self.science_file])
+            self.detector_last_on_time = last_on_times["detector_last_on_time"].item()
 
         logger.info(f"Final config:\n {self.model_dump_json(indent=2)}")
+
+    @staticmethod
+    def resolve_missing_many(configs: list["ChannelReduction"], resolver: Resolver) -> None:
+        """
+        Resolves the missing paths for many channel reduction configs at once.
+        All the matching is done with joins over the filestore, rather than a pass per science file.
+        """
+        logger = get_logger()
+        logger.info(f"Resolving missing paths for {len(configs)} channel reduction configs")
+        science_files = [config.science_file for config in configs]
+        calibrations = resolver.get_calibration_matches(science_files).with_columns(
+            resolver.get_detector_last_on_times(science_files)["detector_last_on_time"]
+        )
+        for config, row in zip(configs, calibrations.iter_rows(named=True), strict=True):
+            if config.arc_file is None:
+                assert row["arc_file"] is not None, f"No matches found for ARC for {config.science_file}"
+                config.arc_file = resolver.data_path / row["arc_file"]
+            if not config.continuum_files:
+                config.continuum_files = [resolver.data_path / path for path in row["continuum_files"]]
+            if config.weather_file is None:
+                assert row["weather_file"] is not None, f"No matches found for WEATHER for {config.science_file}"
+                config.weather_file = resolver.data_path / row["weather_file"]
+            if config.detector_last_on_time is None:
+                config.detector_last_on_time = row["detector_last_on_time"]
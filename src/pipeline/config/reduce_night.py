@@ -0,0 +1,86 @@
+import os
+from datetime import date, time
+from datetime import datetime as dt
+from datetime import timedelta as td
+from datetime import timezone as tz
+from typing import Literal, Self
+from zoneinfo import ZoneInfo
+
+from pydantic import Field, field_validator, model_validator
+from pydantic_settings import BaseSettings
+
+from pipeline.config.reduce_channel_exposure import ChannelReduction
+from pipeline.resolver.resolver import Resolver
+
+# Each exposure already keeps a few cores busy in numpy and polars, and holds its frames in memory, so only a few
+# are reduced at once unless asked for more
+DEFAULT_MAX_WORKERS = min(4, os.cpu_count() or 1)
+
+# Nights on Mauna Kea are split at local noon, so a night's exposures all share the date it started on
+NIGHT_TIMEZONE = ZoneInfo("Pacific/Honolulu")
+
+
+class NightReduction(BaseSettings):
+    night: date | None = Field(
+        default=None,
+        description="Reduce every science exposure from this night, given as the (Hawaii) date the night started on",
+    )
+
+    run_ids: list[str] = Field(default=[], description="Reduce every science exposure from these runs")
+
+    start: dt | None = Field(default=None, description="Reduce every science exposure observed from this time")
+
+    end: dt | None = Field(default=None, description="Reduce every science exposure observed before this time")
+
+    max_workers: int = Field(
+        default=DEFAULT_MAX_WORKERS,
+        ge=1,
+        description="Number of exposures reduced at once",
+    )
+
+    executor: Literal["process", "thread"] = Field(
+        default="process",
+        description="Reduce exposures in a pool of processes, or threads when the work releases the GIL",
+    )
+
+    use_cache: bool = Field(default=True, description="Use cached data when possible")
+
+    make_plots: bool = Field(default=True, description="Make plots of the data")
+
+    @field_validator("start", "end")
+    @classmethod
+    def check_timezone(cls, v: dt | None) -> dt | None:
+        # The filestore holds UTC times, so times without a timezone are taken to be UTC
+        if v is not None and v.tzinfo is None:
+            return v.replace(tzinfo=tz.utc)
+        return v
+
+    @model_validator(mode="after")
+    def check_selection(self) -> Self:
+        assert self.night is not None or self.run_ids or self.start is not None or self.end is not None, (
+            "Select the exposures to reduce with a night, run_ids or a start/end time"
+        )
+        return self
+
+    def observation_time_range(self) -> tuple[dt | None, dt | None]:
+        """
+        The range of observation times to reduce, narrowed to the night when one is given.
+        """
+        start, end = self.start, self.end
+        if self.night is not None:
+            night_start = dt.combine(self.night, time(12), tzinfo=NIGHT_TIMEZONE).astimezone(tz.utc)
+            night_end = night_start + td(days=1)
+            start = night_start if start is None else max(start, night_start)
+            end = night_end if end is None else min(end, night_end)
+        return start, end
+
+    def channel_reductions(self, resolver: Resolver) -> list[ChannelReduction]:
+        """
+        A channel reduction config for each selected science exposure, with its calibration files still to resolve.
+        """
+        start, end = self.observation_time_range()
+        science_files = resolver.find_science_files(run_ids=self.run_ids, start=start, end=end)
+        return [
+            ChannelReduction(science_file=science_file, use_cache=self.use_cache, make_plots=self.make_plots)
+            for science_file in science_files
+        ]
@@ -1,8 +1,11 @@
 from pathlib import Path
 
+from pipeline.common.cache import use_result_cache
 from pipeline.common.log import get_logger
 from pipeline.common.prefect_utils import pipeline_flow
 from pipeline.config import ChannelReduction
+from pipeline.resolver.common import FileType
+from pipeline.resolver.resolver import Resolver
 from pipeline.tasks import (
     augment_science_file,
     calibrate_with_flats,
@@ -12,6 +15,7 @@ from pipeline.tasks import (
 )
 from pipeline.tasks.build_filestore import build_filestore
 from pipeline.tasks.cfht_weather import update_cfht_weather
+from pipeline.tasks.master_calibration import load_master_calibration
 
 
 @pipeline_flow()
@@ -28,12 +32,27 @@ def reduce_star_channel_exposure(config: ChannelReduction) -> None:
     # Ensure that our config is fully specified using the resolver
     config.resolve_missing(resolver)
 
-    # And now we can run the reduction
-    augment_science_file()
-    preprocess_exposure(config, resolver)
-    correct_dichoric()
-    remove_continuum()
-    calibrate_with_flats()
+    reduce_resolved_channel_exposure(config, resolver)
+
+
+@pipeline_flow()
+def reduce_resolved_channel_exposure(config: ChannelReduction, resolver: Resolver) -> None:
+    """
+    Reduce a channel exposure whose config has already been resolved against an up to date filestore.
+    """
+    # Run the reduction, skipping any stages whose inputs haven't changed since the last run
+    with use_result_cache(config.use_cache):
+        augment_science_file()
+        preprocess_exposure(config, resolver)
+        correct_dichoric()
+        remove_continuum()
+        # Flats are shared by the whole night, so the combined master is only built by the first exposure to need it.
+        # Arcs can be loaded the same way (FileType.ARC), but aren't until a stage uses them, as that would only add
+        # a build per arc for nothing to read it.
+        master_flat = None
+        if config.continuum_files:
+            master_flat = load_master_calibration(FileType.CONTINUUM, config.continuum_files, resolver)
+        calibrate_with_flats(master_flat)
 
 
 if __name__ == "__main__":
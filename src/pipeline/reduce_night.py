@@ -0,0 +1,117 @@
+import multiprocessing
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed as as_completed_processes
+from datetime import date
+from pathlib import Path
+
+from prefect.futures import as_completed
+from prefect.task_runners import ThreadPoolTaskRunner
+
+from pipeline.common.log import get_logger, setup_logging
+from pipeline.common.prefect_utils import pipeline_flow, pipeline_task, plain_calls
+from pipeline.config import ChannelReduction, NightReduction
+from pipeline.reduce_channel_exposure import reduce_resolved_channel_exposure
+from pipeline.resolver.resolver import Resolver
+from pipeline.tasks.build_filestore import build_filestore
+from pipeline.tasks.cfht_weather import update_cfht_weather
+
+
+@pipeline_task()
+def reduce_exposure(config: ChannelReduction, resolver: Resolver) -> None:
+    """
+    Reduce a single resolved exposure, as a task of the night's flow so its run is tracked under it.
+    """
+    reduce_resolved_channel_exposure(config, resolver)
+
+
+def reduce_exposure_worker(config: ChannelReduction, resolver: Resolver) -> None:
+    """
+    Process pool entry point for a single resolved exposure, kept at module level so it can be pickled.
+    A Prefect run started in a spawned process would be unrelated to the night's flow, so the reduction is run
+    as plain function calls, with failures reported back through the pool.
+    """
+    setup_logging()
+    with plain_calls():
+        reduce_resolved_channel_exposure(config, resolver)
+
+
+def reduce_exposures(
+    config: NightReduction, channel_configs: list[ChannelReduction], resolver: Resolver, max_workers: int
+) -> Iterator[tuple[Path, Exception | None]]:
+    """
+    Reduce exposures several at a time, yielding each science file with the error that stopped it (if any)
+    as it finishes. Threads are Prefect task runs of the night's flow, processes are plain pool workers.
+    """
+    if config.executor == "thread":
+        with ThreadPoolTaskRunner(max_workers=max_workers) as runner:
+            futures = {
+                runner.submit(reduce_exposure, {"config": channel_config, "resolver": resolver}): (
+                    channel_config.science_file
+                )
+                for channel_config in channel_configs
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    yield futures[future], e
+                else:
+                    yield futures[future], None
+        return
+
+    # Spawn rather than fork, as forking while polars' thread pool is running can deadlock
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+        futures = {
+            executor.submit(reduce_exposure_worker, channel_config, resolver): channel_config.science_file
+            for channel_config in channel_configs
+        }
+        for future in as_completed_processes(futures):
+            yield futures[future], future.exception()
+
+
+@pipeline_flow()
+def reduce_night(config: NightReduction) -> None:
+    """
+    Reduce every selected science exposure, several at a time.
+    External data and the filestore are synchronised once up front, rather than by every exposure.
+    """
+    logger = get_logger()
+    logger.info(f"Starting night reduction with settings:\n {config.model_dump_json(indent=2)}")
+
+    # Synchronise with any external data sources which may have changed
+    update_cfht_weather()
+
+    # Load in the existing file store and ensure its up to date. Workers only read it, so it is brought up to
+    # date and compacted once here rather than by each of them.
+    resolver = build_filestore()
+    resolver.compact_filestore()
+
+    # Resolve the calibration files for every exposure in one pass over the filestore
+    channel_configs = config.channel_reductions(resolver)
+    if not channel_configs:
+        logger.info("No science exposures found for the selection. Nothing to reduce.")
+        return
+    ChannelReduction.resolve_missing_many(channel_configs, resolver)
+
+    # Workers get a fresh, read only resolver, so a process pool doesn't pickle the loaded filestore across to each
+    # of them and none of them write to it
+    worker_resolver = Resolver(**(resolver.model_dump() | {"read_only": True}))
+    max_workers = min(config.max_workers, len(channel_configs))
+    logger.info(f"Reducing {len(channel_configs)} exposures with {max_workers} {config.executor} worker(s)")
+
+    failed = []
+    for science_file, error in reduce_exposures(config, channel_configs, worker_resolver, max_workers):
+        if error is not None:
+            logger.error(f"Failed to reduce {science_file}: {type(error).__name__}: {error}")
+            failed.append(science_file)
+        else:
+            logger.info(f"Reduced {science_file}")
+
+    logger.info(f"Reduced {len(channel_configs) - len(failed)} of {len(channel_configs)} exposures")
+    assert not failed, f"Failed to reduce {len(failed)} exposures: {[str(path) for path in failed]}"
+
+
+if __name__ == "__main__":
+    reduce_night(NightReduction(night=date(2025, 2, 25)))
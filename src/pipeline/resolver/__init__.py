@@ -1,4 +1,5 @@
-from pipeline.resolver.common import FileStoreDataFrame, FileStoreEntry
+from pipeline.resolver.common import FileStoreDataFrame, FileStoreEntry, FileStoreRecord, FileStoreRecords
+from pipeline.resolver.index import FileStoreIndex, FileStoreScan
 from pipeline.resolver.match_arc import find_arc_files
 from pipeline.resolver.match_continuum_flats import find_highsn_continuum_files
 from pipeline.resolver.match_raw_logs import find_raw_log_files
@@ -10,4 +11,8 @@ __all__ = [
     "Resolver",
     "FileStoreDataFrame",
     "FileStoreEntry",
+    "FileStoreRecord",
+    "FileStoreRecords",
+    "FileStoreIndex",
+    "FileStoreScan",
 ]
@@ -1,10 +1,13 @@
+from collections.abc import Iterable, Sequence
 from datetime import datetime as dt
 from datetime import timezone as tz
 from enum import StrEnum
+from functools import cache
 from pathlib import Path
-from typing import Annotated
+from typing import Annotated, overload
 
 import pandera as pa
+import polars as pl
 import polars.selectors as cs
 from astropy.io import fits
 from pandera.engines.polars_engine import DateTime
@@ -12,6 +15,9 @@ from pandera.polars import DataFrameModel
 from pandera.typing.polars import DataFrame, Series
 from pydantic import BaseModel
 
+from pipeline.common.files import file_fingerprint
+from pipeline.resolver.fits_header import read_primary_header
+
 UTCDatetime = Annotated[DateTime, False, "UTC", "ms"]
 DATETIME_CONVERSION_EXPR = cs.datetime().dt.cast_time_unit("ms").dt.convert_time_zone("UTC")
 
@@ -46,6 +52,9 @@ class FileStoreModel(DataFrameModel):
     filter: Series[str] = pa.Field(nullable=True)
     channel: Series[str] = pa.Field(nullable=True)
     detector: Series[str] = pa.Field(nullable=True)
+    file_size: Series[int] | None = pa.Field(nullable=True)
+    file_mtime_ns: Series[int] | None = pa.Field(nullable=True)
+    file_inode: Series[int] | None = pa.Field(nullable=True)
 
 
 FileStoreDataFrame = DataFrame[FileStoreModel]
@@ -71,6 +80,78 @@ class FileStoreEntry(BaseModel):
     filter: str | None
     channel: str | None
     detector: str | None
+    file_size: int | None = None
+    file_mtime_ns: int | None = None
+    file_inode: int | None = None
+
+
+class FileStoreRecord:
+    """
+    A lightweight record for a filestore row that has already been validated.
+    Holds the same fields as `FileStoreEntry` without running pydantic validation, use `to_entry` when a
+    validated model is needed at an API boundary.
+    """
+
+    __slots__ = tuple(FileStoreEntry.model_fields)
+
+    def __init__(self, **values) -> None:
+        for field in self.__slots__:
+            setattr(self, field, values.get(field))
+        # Rows come out of polars with the type as a plain string
+        if self.type is not None:
+            self.type = FileType(self.type)
+
+    def __repr__(self) -> str:
+        return f"FileStoreRecord(file_path={self.file_path!r}, type={self.type!r})"
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, FileStoreRecord | FileStoreEntry):
+            return self.model_dump() == other.model_dump()
+        return NotImplemented
+
+    def model_dump(self) -> dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def model_dump_json(self, indent: int | None = None) -> str:
+        return self.to_entry().model_dump_json(indent=indent)
+
+    def to_entry(self) -> FileStoreEntry:
+        return FileStoreEntry.model_validate(self.model_dump())
+
+
+class FileStoreRecords(Sequence[FileStoreRecord]):
+    """
+    A sequence of filestore records backed by a polars frame.
+    Records are only built when they are accessed, so large matches stay cheap until used.
+    """
+
+    def __init__(self, frame: pl.DataFrame) -> None:
+        self.frame = frame
+
+    def __len__(self) -> int:
+        return len(self.frame)
+
+    @overload
+    def __getitem__(self, index: int) -> FileStoreRecord: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> "FileStoreRecords": ...
+
+    def __getitem__(self, index: int | slice) -> "FileStoreRecord | FileStoreRecords":
+        if isinstance(index, slice):
+            return FileStoreRecords(self.frame[index])
+        if index < 0:
+            index += len(self.frame)
+        if not 0 <= index < len(self.frame):
+            raise IndexError(f"Record {index} out of range for {len(self.frame)} records")
+        return FileStoreRecord(**self.frame.row(index, named=True))
+
+    def __repr__(self) -> str:
+        return f"FileStoreRecords({len(self)} records)"
+
+    @property
+    def file_paths(self) -> list[str]:
+        return self.frame["file_path"].to_list()
 
 
 HEADER_MAP = {
@@ -87,34 +168,86 @@ HEADER_MAP = {
     "object_dec": "OBJDEC",
 }
 
+FINGERPRINT_COLUMNS = ["file_size", "file_mtime_ns", "file_inode"]
 
-def extra_details_from_fits(path: Path) -> dict[str, str | int | float | dt]:
-    values = {}
+
+@cache
+def header_keywords() -> dict[str, str]:
+    """
+    Map of filestore column to the FITS header keyword it is read from.
+    """
+    return {column: HEADER_MAP.get(column, column).upper() for column in FileStoreModel.to_schema().columns}
+
+
+def read_header_with_astropy(path: Path, keywords: Iterable[str]) -> dict[str, str | bool | int | float]:
     with fits.open(path) as hdul:  # type: ignore
         # Assume headers are in the first HDU
         header = hdul[0].header  # type: ignore
-        # Extract relevant information from the header
-        for column in FileStoreModel.to_schema().columns:
-            expected_column_name = HEADER_MAP.get(column, column)
-            if expected_column_name in header:
-                value = header[expected_column_name]
-                if isinstance(value, str):
-                    value = value.strip()
-                if column.startswith("time"):
-                    if isinstance(value, int):
-                        value = dt.fromtimestamp(value, tz=tz.utc)
-                    elif isinstance(value, str):
-                        value = dt.strptime(value, "%Y-%m-%dT%H:%M:%S").replace(tzinfo=tz.utc)
-                values[column] = value
+        return {keyword: header[keyword] for keyword in keywords if keyword in header}
+
+
+def extra_details_from_fits(path: Path) -> dict[str, str | int | float | dt]:
+    keywords = header_keywords()
+    try:
+        header = read_primary_header(path, keywords.values())
+    except ValueError:
+        # Anything our fast reader can't handle, astropy can
+        header = read_header_with_astropy(path, keywords.values())
+
+    values = {}
+    # Extract relevant information from the header
+    for column, expected_column_name in keywords.items():
+        if expected_column_name in header:
+            value = header[expected_column_name]
+            if isinstance(value, str):
+                value = value.strip()
+            if column.startswith("time"):
+                if isinstance(value, int):
+                    value = dt.fromtimestamp(value, tz=tz.utc)
+                elif isinstance(value, str):
+                    value = dt.strptime(value, "%Y-%m-%dT%H:%M:%S").replace(tzinfo=tz.utc)
+            values[column] = value
     return values
 
 
-def extract_file_details(path: Path, relative_path: Path) -> FileStoreDataFrame:
+FileRecord = dict[str, str | bool | int | float | dt | None]
+
+
+@cache
+def file_record_dtypes() -> dict[str, pl.DataType]:
+    """
+    Polars dtypes for the filestore columns when assembling raw records.
+    The file type is left as a string and coerced by the schema, so unknown types fail validation as before.
+    """
+    return {
+        column: pl.String if isinstance(field.dtype.type, pl.Enum) else field.dtype.type
+        for column, field in FileStoreModel.to_schema().columns.items()
+    }
+
+
+def file_records_to_frame(records: list[FileRecord]) -> pl.DataFrame:
+    """
+    Assemble extracted file records into a single frame in one go.
+    Values are gathered into plain column buffers first, which is far cheaper than a frame per file.
+    The result is not validated, that is left to the caller once the final table is built.
+    """
+    dtypes = file_record_dtypes()
+    columns: dict[str, list] = {column: [] for column in dtypes}
+    for i, record in enumerate(records):
+        # Hive partitions can add columns that aren't in the schema
+        for key in record.keys() - columns.keys():
+            columns[key] = [None] * i
+        for column, buffer in columns.items():
+            buffer.append(record.get(column))
+    return pl.DataFrame(columns, schema_overrides=dtypes, strict=False)
+
+
+def extract_file_record(path: Path, relative_path: Path) -> FileRecord:
     values = {
         "file_path": str(relative_path),
         "file_name": path.name,
         "time_added": dt.now(tz=tz.utc),
-    }
+    } | dict(zip(FINGERPRINT_COLUMNS, file_fingerprint(path), strict=True))
     if path.suffix == ".fits":
         values = extra_details_from_fits(path) | values
 
@@ -130,4 +263,8 @@ def extract_file_details(path: Path, relative_path: Path) -> FileStoreDataFrame:
         pass
         # Some check here
 
-    return FileStoreDataFrame(values)
+    return values
+
+
+def extract_file_details(path: Path, relative_path: Path) -> FileStoreDataFrame:
+    return FileStoreDataFrame(file_records_to_frame([extract_file_record(path, relative_path)]))
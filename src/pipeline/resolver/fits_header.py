@@ -0,0 +1,85 @@
+import re
+from collections.abc import Iterable
+from pathlib import Path
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+INT_REGEX = re.compile(r"[+-]?\d+")
+FLOAT_REGEX = re.compile(r"[+-]?(\d+\.?\d*|\.\d+)([EDed][+-]?\d+)?")
+
+HeaderValue = str | bool | int | float
+
+
+def parse_card_value(value_field: str) -> HeaderValue:
+    """
+    Parse the value field of a FITS card (everything after the `= ` value indicator).
+    Anything we don't handle the same way astropy does raises a ValueError.
+    """
+    field = value_field.lstrip()
+    if field.startswith("'"):
+        # Strings end at the first lone quote, with '' being an escaped quote
+        parts, start = [], 1
+        while True:
+            end = field.find("'", start)
+            if end == -1:
+                raise ValueError(f"Unterminated string in FITS card value {value_field!r}")
+            parts.append(field[start:end])
+            if field[end + 1 : end + 2] != "'":
+                break
+            parts.append("'")
+            start = end + 2
+        return "".join(parts).rstrip()
+
+    value = field.split("/", 1)[0].strip()
+    if value == "T":
+        return True
+    if value == "F":
+        return False
+    if INT_REGEX.fullmatch(value):
+        return int(value)
+    if FLOAT_REGEX.fullmatch(value):
+        return float(value.replace("D", "E").replace("d", "e"))
+    raise ValueError(f"Unsupported FITS card value {value_field!r}")
+
+
+def read_primary_header(path: Path, keywords: Iterable[str]) -> dict[str, HeaderValue]:
+    """
+    Read the requested keywords from the primary header of a FITS file.
+
+    This only reads the leading 2880 byte header blocks of HDU 0 and only decodes the cards we ask for,
+    which is far cheaper than a full `fits.open`. Keywords are matched case insensitively and returned
+    upper case. Malformed or unusual headers raise a ValueError so callers can fall back to astropy.
+    """
+    wanted = {keyword.upper() for keyword in keywords}
+    values: dict[str, HeaderValue] = {}
+    with open(path, "rb") as f:
+        block_index = 0
+        while block := f.read(BLOCK_SIZE):
+            if len(block) != BLOCK_SIZE:
+                raise ValueError(f"Truncated FITS header block in {path}")
+            text = block.decode("ascii")
+            if block_index == 0 and not text.startswith("SIMPLE  ="):
+                raise ValueError(f"{path} does not start with a SIMPLE card")
+            block_index += 1
+
+            for offset in range(0, BLOCK_SIZE, CARD_SIZE):
+                card = text[offset : offset + CARD_SIZE]
+                if card.startswith("HIERARCH "):
+                    keyword, _, value_field = card[9:].partition("=")
+                    keyword = keyword.strip().upper()
+                elif card[8:10] == "= ":
+                    keyword, value_field = card[:8].rstrip(), card[10:]
+                else:
+                    if card[:8].rstrip() == "END":
+                        return values
+                    continue
+
+                # Duplicate keywords resolve to the first card, like astropy does
+                if keyword not in wanted or keyword in values:
+                    continue
+                value = parse_card_value(value_field)
+                if isinstance(value, str) and value.endswith("&"):
+                    raise ValueError(f"Long string (CONTINUE) value for {keyword} in {path}")
+                values[keyword] = value
+    raise ValueError(f"No END card found in the primary header of {path}")
@@ -0,0 +1,137 @@
+from collections.abc import Callable
+from functools import cached_property
+
+import polars as pl
+
+from pipeline.resolver.common import FileStoreDataFrame, FileType
+
+GroupKey = tuple[str, str | None, str | None]
+
+
+class FileStoreIndex:
+    """
+    Hash indexes over a loaded filestore, so metadata and match lookups don't need to scan the whole frame.
+
+    Indexes are built once, when the filestore is loaded:
+    - file_path -> row
+    - type -> rows
+    - (type, run_id, channel) -> rows
+    """
+
+    def __init__(self, file_store: FileStoreDataFrame):
+        self.file_store = file_store
+        self.path_index: dict[str, int] = {path: i for i, path in enumerate(file_store["file_path"].to_list())}
+
+        groups = (
+            file_store.select("type", "run_id", "channel")
+            .with_row_index("row")
+            .group_by("type", "run_id", "channel")
+            .agg(pl.col("row"))
+        )
+        self.group_index: dict[GroupKey, list[int]] = {}
+        self.type_index: dict[str, list[int]] = {}
+        for file_type, run_id, channel, rows in groups.iter_rows():
+            self.group_index[(file_type, run_id, channel)] = rows
+            self.type_index.setdefault(file_type, []).extend(rows)
+
+    def __len__(self) -> int:
+        return len(self.file_store)
+
+    def get_row(self, file_path: str) -> dict | None:
+        row = self.path_index.get(file_path)
+        if row is None:
+            return None
+        return self.file_store.row(row, named=True)
+
+    def get_rows(self, file_paths: list[str]) -> pl.DataFrame:
+        """
+        Get the rows for many files at once, in the order given.
+        """
+        rows = [self.path_index.get(file_path) for file_path in file_paths]
+        missing = [path for path, row in zip(file_paths, rows, strict=True) if row is None]
+        if missing:
+            raise FileNotFoundError(f"Files {missing} not found in file store.")
+        return self.file_store[rows]
+
+    def take(self, rows: list[int]) -> pl.DataFrame:
+        # Keep rows in filestore order, so results match a filter over the whole frame
+        return self.file_store[sorted(rows)]
+
+    def of_type(self, file_type: str | FileType) -> pl.DataFrame:
+        return self.take(self.type_index.get(str(file_type), []))
+
+    def of_group(self, file_type: str | FileType, run_id: str | None, channel: str | None) -> pl.DataFrame:
+        # A null run_id or channel never matches, in line with polars' null semantics for `eq`
+        if run_id is None or channel is None:
+            return self.take([])
+        return self.take(self.group_index.get((str(file_type), run_id, channel), []))
+
+
+class FileStoreScan:
+    """
+    The same lookups as `FileStoreIndex`, but over a lazily scanned filestore.
+    Each lookup is a filter pushed down to the scan, so with a partitioned filestore only the matching
+    type and run_id partitions are ever read. Only where each file is, its type and run_id, is held in memory,
+    so a lookup by path reads just the one partition the file is in.
+    """
+
+    def __init__(self, scan: Callable[[pl.Expr | None], pl.LazyFrame]):
+        self.scan = scan
+
+    @cached_property
+    def partition_index(self) -> dict[str, tuple[str, str | None]]:
+        locations = self.scan(None).select("file_path", "type", "run_id").collect()
+        return {file_path: (file_type, run_id) for file_path, file_type, run_id in locations.iter_rows()}
+
+    def __len__(self) -> int:
+        return len(self.partition_index)
+
+    def collect(self, predicate: pl.Expr) -> pl.DataFrame:
+        return self.scan(predicate).collect()
+
+    def in_partitions(self, file_paths: list[str]) -> pl.Expr:
+        """
+        A predicate for rows of the given (known) files, which also picks out the partitions they are in.
+        """
+        locations = {self.partition_index[file_path] for file_path in file_paths}
+        run_ids = {run_id for _, run_id in locations}
+        run_id_predicate = pl.col("run_id").is_in([run_id for run_id in run_ids if run_id is not None])
+        if None in run_ids:
+            run_id_predicate |= pl.col("run_id").is_null()
+        return (
+            pl.col("type").is_in([file_type for file_type, _ in locations])
+            & run_id_predicate
+            & pl.col("file_path").is_in(file_paths)
+        )
+
+    def get_row(self, file_path: str) -> dict | None:
+        if file_path not in self.partition_index:
+            return None
+        rows = self.collect(self.in_partitions([file_path]))
+        if rows.is_empty():
+            return None
+        return rows.row(0, named=True)
+
+    def get_rows(self, file_paths: list[str]) -> pl.DataFrame:
+        missing = [file_path for file_path in file_paths if file_path not in self.partition_index]
+        if missing:
+            raise FileNotFoundError(f"Files {missing} not found in file store.")
+        found = self.collect(self.in_partitions(file_paths))
+        return (
+            pl.DataFrame({"file_path": file_paths})
+            .join(found, on="file_path", how="left", maintain_order="left")
+            .select(found.columns)
+        )
+
+    def of_type(self, file_type: str | FileType) -> pl.DataFrame:
+        return self.collect(pl.col("type").eq(str(file_type)))
+
+    def of_group(self, file_type: str | FileType, run_id: str | None, channel: str | None) -> pl.DataFrame:
+        if run_id is None or channel is None:
+            return self.scan(None).limit(0).collect()
+        return self.collect(
+            pl.col("type").eq(str(file_type)) & pl.col("run_id").eq(run_id) & pl.col("channel").eq(channel)
+        )
+
+
+FileStoreLookup = FileStoreIndex | FileStoreScan
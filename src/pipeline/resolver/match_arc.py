@@ -1,20 +1,30 @@
 import polars as pl
 
-from pipeline.resolver.common import FileStoreDataFrame, FileStoreEntry, FileType
+from pipeline.resolver.common import FileStoreRecord, FileStoreRecords, FileType
+from pipeline.resolver.index import FileStoreLookup
 from pipeline.resolver.registry import file_match_registry
 
 
 @file_match_registry.register(FileType.ARC)
-def find_arc_files(science_file: FileStoreEntry | None, file_store: FileStoreDataFrame) -> list[FileStoreEntry]:
+def find_arc_files(science_file: FileStoreRecord | None, file_store: FileStoreLookup) -> FileStoreRecords:
     """
     Find the arc file for a given science file.
     """
     assert science_file is not None, "science_file must be provided. There is no global suitable ARC file."
     # Try to match on the run_id
-    files = file_store.filter(
-        (pl.col("type").eq(FileType.ARC.value))
-        & (pl.col("run_id").eq(science_file.run_id))
-        & (pl.col("object").eq(science_file.object))
-        & (pl.col("channel").eq(science_file.channel))
+    files = file_store.of_group(FileType.ARC, science_file.run_id, science_file.channel).filter(
+        pl.col("object").eq(science_file.object)
+    )
+    return FileStoreRecords(files)
+
+
+@file_match_registry.register_batch(FileType.ARC)
+def find_arc_files_batch(science_files: pl.DataFrame, file_store: FileStoreLookup) -> pl.DataFrame:
+    """
+    Vectorised version of `find_arc_files`, joining every science file against the arc files in one go.
+    """
+    keys = ["run_id", "object", "channel"]
+    candidates = file_store.of_type(FileType.ARC).select(*keys, "file_path")
+    return science_files.select(pl.col("file_path").alias("primary_path"), *keys).join(
+        candidates, on=keys, how="inner", maintain_order="left_right"
     )
-    return [FileStoreEntry.model_validate(row) for row in files.to_dicts()]
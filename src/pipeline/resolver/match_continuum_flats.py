@@ -1,23 +1,31 @@
 import polars as pl
 
-from pipeline.resolver.common import FileStoreDataFrame, FileStoreEntry, FileType
+from pipeline.resolver.common import FileStoreRecord, FileStoreRecords, FileType
+from pipeline.resolver.index import FileStoreLookup
 from pipeline.resolver.registry import file_match_registry
 
 
 @file_match_registry.register(FileType.CONTINUUM)
-def find_highsn_continuum_files(
-    science_file: FileStoreEntry | None, file_store: FileStoreDataFrame
-) -> list[FileStoreEntry]:
+def find_highsn_continuum_files(science_file: FileStoreRecord | None, file_store: FileStoreLookup) -> FileStoreRecords:
     """
     Find the arc file for a given science file.
     """
     assert science_file is not None, "science_file must be provided. There is no global suitable continuum file."
 
     # Try to match on the run_id
-    files = file_store.filter(
-        (pl.col("type").eq(FileType.CONTINUUM.value))
-        & (pl.col("run_id").eq(science_file.run_id))
-        & (pl.col("object").eq(science_file.object))
-        & (pl.col("channel").eq(science_file.channel))
+    files = file_store.of_group(FileType.CONTINUUM, science_file.run_id, science_file.channel).filter(
+        pl.col("object").eq(science_file.object)
+    )
+    return FileStoreRecords(files)
+
+
+@file_match_registry.register_batch(FileType.CONTINUUM)
+def find_highsn_continuum_files_batch(science_files: pl.DataFrame, file_store: FileStoreLookup) -> pl.DataFrame:
+    """
+    Vectorised version of `find_highsn_continuum_files`, joining every science file against the flats in one go.
+    """
+    keys = ["run_id", "object", "channel"]
+    candidates = file_store.of_type(FileType.CONTINUUM).select(*keys, "file_path")
+    return science_files.select(pl.col("file_path").alias("primary_path"), *keys).join(
+        candidates, on=keys, how="inner", maintain_order="left_right"
     )
-    return [FileStoreEntry.model_validate(row) for row in files.to_dicts()]
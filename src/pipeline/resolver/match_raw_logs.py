@@ -1,13 +1,25 @@
 import polars as pl
 
-from pipeline.resolver.common import FileStoreDataFrame, FileStoreEntry, FileType
+from pipeline.resolver.common import FileStoreRecord, FileStoreRecords, FileType
+from pipeline.resolver.index import FileStoreLookup
 from pipeline.resolver.registry import file_match_registry
 
 
 @file_match_registry.register(FileType.RAW_LOGS)
-def find_raw_log_files(science_file: FileStoreEntry | None, file_store: FileStoreDataFrame) -> list[FileStoreEntry]:
+def find_raw_log_files(science_file: FileStoreRecord | None, file_store: FileStoreLookup) -> FileStoreRecords:
     """
     Finds the raw logs file. Does not care about what the science file is right now.
     """
-    files = file_store.filter((pl.col("type").eq(FileType.RAW_LOGS.value)))
-    return [FileStoreEntry.model_validate(row) for row in files.to_dicts()]
+    files = file_store.of_type(FileType.RAW_LOGS)
+    return FileStoreRecords(files)
+
+
+@file_match_registry.register_batch(FileType.RAW_LOGS)
+def find_raw_log_files_batch(science_files: pl.DataFrame, file_store: FileStoreLookup) -> pl.DataFrame:
+    """
+    Vectorised version of `find_raw_log_files`. Every science file gets every raw logs file.
+    """
+    candidates = file_store.of_type(FileType.RAW_LOGS).select("file_path")
+    return science_files.select(pl.col("file_path").alias("primary_path")).join(
+        candidates, how="cross", maintain_order="left_right"
+    )
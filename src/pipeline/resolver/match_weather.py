@@ -1,13 +1,81 @@
+from datetime import datetime as dt
+from datetime import timedelta as td
+
 import polars as pl
 
-from pipeline.resolver.common import FileStoreDataFrame, FileStoreEntry, FileType
+from pipeline.resolver.common import FileStoreRecord, FileStoreRecords, FileType
+from pipeline.resolver.index import FileStoreLookup
 from pipeline.resolver.registry import file_match_registry
 
+# Weather is partitioned by the UTC year and month of the data, which the filestore picks up as hive columns
+PARTITION_COLUMNS = ["year", "month"]
+
 
 @file_match_registry.register(FileType.WEATHER)
-def find_weather_files(science_file: FileStoreEntry | None, file_store: FileStoreDataFrame) -> list[FileStoreEntry]:
+def find_weather_files(science_file: FileStoreRecord | None, file_store: FileStoreLookup) -> FileStoreRecords:
     """
-    Finds the weather file. Does not care about what the science file is right now.
+    Finds the weather files. For partitioned weather, the partition covering the observation comes first, followed
+    by the month before it, as weather is looked up a little before the observation. When there is no observation
+    time or no partition covers it, every weather file is returned.
     """
-    files = file_store.filter((pl.col("type").eq(FileType.WEATHER.value)))
-    return [FileStoreEntry.model_validate(row) for row in files.to_dicts()]
+    files = file_store.of_type(FileType.WEATHER)
+    observed = None if science_file is None else science_file.time_observation
+    if observed is None or not set(PARTITION_COLUMNS).issubset(files.columns):
+        return FileStoreRecords(files)
+    month_start = dt(observed.year, observed.month, 1)
+    previous_month_start = month_start - td(days=1)
+    covering = files.filter(pl.col("year").eq(f"{month_start:%Y}"), pl.col("month").eq(f"{month_start:%m}"))
+    if covering.is_empty():
+        return FileStoreRecords(files)
+    earlier = files.filter(
+        pl.col("year").eq(f"{previous_month_start:%Y}"), pl.col("month").eq(f"{previous_month_start:%m}")
+    )
+    return FileStoreRecords(pl.concat([covering, earlier]))
+
+
+@file_match_registry.register_batch(FileType.WEATHER)
+def find_weather_files_batch(science_files: pl.DataFrame, file_store: FileStoreLookup) -> pl.DataFrame:
+    """
+    Vectorised version of `find_weather_files`, joining every science file onto the partition covering it and the
+    one before, or onto every weather file when no partition covers it.
+    """
+    candidates = file_store.of_type(FileType.WEATHER)
+    primaries = science_files.select(pl.col("file_path").alias("primary_path"), "time_observation")
+    if not set(PARTITION_COLUMNS).issubset(candidates.columns):
+        return primaries.drop("time_observation").join(
+            candidates.select("file_path"), how="cross", maintain_order="left_right"
+        )
+    primaries = primaries.with_row_index("primary_index")
+    candidates = candidates.select(*PARTITION_COLUMNS, "file_path").with_row_index("candidate_index")
+
+    # The covering month has rank 0 and the month before rank 1, so covering partitions are listed first
+    month_start = pl.col("time_observation").dt.truncate("1mo")
+    wanted = pl.concat(
+        [
+            primaries.select(
+                "primary_index", month_start.dt.offset_by(f"-{rank}mo").alias("month_start"), pl.lit(rank).alias("rank")
+            )
+            for rank in (0, 1)
+        ]
+    ).select(
+        "primary_index",
+        "rank",
+        pl.col("month_start").dt.strftime("%Y").alias("year"),
+        pl.col("month_start").dt.strftime("%m").alias("month"),
+    )
+    matched = wanted.join(candidates, on=PARTITION_COLUMNS, how="inner")
+    covered = matched.filter(pl.col("rank") == 0)["primary_index"].unique()
+    matched = matched.filter(pl.col("primary_index").is_in(covered))
+    # A null time has a null month, so never matches and falls back with the uncovered primaries
+    uncovered = (
+        primaries.filter(~pl.col("primary_index").is_in(covered))
+        .select("primary_index")
+        .join(candidates, how="cross")
+        .with_columns(pl.lit(0).alias("rank"))
+    )
+    return (
+        pl.concat([matched, uncovered], how="diagonal_relaxed")
+        .sort("primary_index", "rank", "candidate_index")
+        .join(primaries.select("primary_index", "primary_path"), on="primary_index", maintain_order="left")
+        .select("primary_path", "file_path")
+    )
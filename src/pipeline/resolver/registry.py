@@ -1,11 +1,19 @@
 from collections.abc import Callable
 
-from pipeline.resolver.common import FileStoreDataFrame, FileStoreEntry, FileType
+import polars as pl
+
+from pipeline.resolver.common import FileStoreEntry, FileStoreRecord, FileStoreRecords, FileType
+from pipeline.resolver.index import FileStoreLookup
+
+PrimaryFile = FileStoreRecord | FileStoreEntry
+Matcher = Callable[[PrimaryFile | None, FileStoreLookup], FileStoreRecords]
+BatchMatcher = Callable[[pl.DataFrame, FileStoreLookup], pl.DataFrame]
 
 
 class FileMatchRegistry:
     def __init__(self):
         self.registry = {}
+        self.batch_registry = {}
 
     def register(self, file_type: str | FileType):
         if isinstance(file_type, FileType):
@@ -13,17 +21,32 @@ class FileMatchRegistry:
 
         assert file_type not in self.registry, f"File resolver for {file_type} is already registered."
 
-        def wrapper(
-            func: Callable[[FileStoreEntry | None, FileStoreDataFrame], list[FileStoreEntry]],
-        ) -> Callable[[FileStoreEntry | None, FileStoreDataFrame], list[FileStoreEntry]]:
+        def wrapper(func: Matcher) -> Matcher:
             self.registry[file_type] = func
             return func
 
         return wrapper
 
+    def register_batch(self, file_type: str | FileType):
+        """
+        Register a vectorised matcher for many primary files at once.
+        It takes the primary filestore rows and returns a frame of (primary_path, file_path) pairs,
+        in the same order the single file matcher would return them for each primary.
+        """
+        if isinstance(file_type, FileType):
+            file_type = file_type.value
+
+        assert file_type not in self.batch_registry, f"Batch file resolver for {file_type} is already registered."
+
+        def wrapper(func: BatchMatcher) -> BatchMatcher:
+            self.batch_registry[file_type] = func
+            return func
+
+        return wrapper
+
     def get_matches(
-        self, file_type: str | FileType, input_entry: FileStoreEntry | None, file_store: FileStoreDataFrame
-    ) -> list[FileStoreEntry]:
+        self, file_type: str | FileType, input_entry: PrimaryFile | None, file_store: FileStoreLookup
+    ) -> FileStoreRecords:
         if isinstance(file_type, FileType):
             file_type = file_type.value
         assert file_type in self.registry
@@ -31,8 +54,8 @@ class FileMatchRegistry:
         return func(input_entry, file_store)
 
     def get_match(
-        self, file_type: str | FileType, primary: FileStoreEntry | None, file_store: FileStoreDataFrame
-    ) -> FileStoreEntry:
+        self, file_type: str | FileType, primary: PrimaryFile | None, file_store: FileStoreLookup
+    ) -> FileStoreRecord:
         matches = self.get_matches(file_type, primary, file_store)
         assert matches, (
             f"No matches found for {file_type} for primary file "
@@ -40,5 +63,24 @@ class FileMatchRegistry:
         )
         return matches[0]
 
+    def get_batch_matches(
+        self, file_type: str | FileType, primaries: pl.DataFrame, file_store: FileStoreLookup
+    ) -> pl.DataFrame:
+        """
+        Get the matches for many primary files at once, as (primary_path, file_path) pairs.
+        File types without a batch matcher fall back to running the single file matcher per primary.
+        """
+        if isinstance(file_type, FileType):
+            file_type = file_type.value
+        if file_type in self.batch_registry:
+            return self.batch_registry[file_type](primaries, file_store).select("primary_path", "file_path")
+
+        pairs = [
+            (primary.file_path, match_path)
+            for primary in FileStoreRecords(primaries)
+            for match_path in self.get_matches(file_type, primary, file_store).file_paths
+        ]
+        return pl.DataFrame(pairs, schema={"primary_path": pl.String, "file_path": pl.String}, orient="row")
+
 
 file_match_registry = FileMatchRegistry()
@@ -1,12 +1,32 @@
+import fcntl
+import os
+import shutil
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from datetime import datetime as dt
 from functools import cached_property
 from pathlib import Path
 
 import polars as pl
-from pydantic import BaseModel, field_validator
+from pydantic import BaseModel, PrivateAttr, field_validator
 
+from pipeline.common.files import atomic_write, staging_path
+from pipeline.common.products import ProductStore
 from pipeline.config.global_settings import settings
 from pipeline.resolver import file_match_registry
-from pipeline.resolver.common import FileStoreDataFrame, FileStoreEntry, FileType, extract_file_details
+from pipeline.resolver.common import (
+    FINGERPRINT_COLUMNS,
+    FileStoreDataFrame,
+    FileStoreRecord,
+    FileStoreRecords,
+    FileType,
+    extract_file_record,
+    file_fingerprint,
+    file_records_to_frame,
+)
+from pipeline.resolver.index import FileStoreIndex, FileStoreLookup, FileStoreScan
+from pipeline.resolver.registry import PrimaryFile
 
 
 class Resolver(BaseModel):
@@ -17,6 +37,18 @@ class Resolver(BaseModel):
     data_path: Path
     output_path: Path
 
+    # Store the filestore as a hive partitioned dataset (by type and run_id) which is scanned lazily
+    partition_file_store: bool = False
+
+    # Once there are more delta segments than this, they are compacted into the main filestore
+    max_file_store_deltas: int = 64
+
+    # For workers that share a filestore kept up to date by whoever started them, and must not write to it
+    read_only: bool = False
+
+    # The delta segments merged into the currently loaded filestore
+    _loaded_deltas: list[Path] = PrivateAttr(default_factory=list)
+
     @field_validator("file_store_path")
     @classmethod
     def check_file_store_path(cls, v: str | Path) -> Path:
@@ -29,97 +61,389 @@ class Resolver(BaseModel):
 
     @cached_property
     def file_store(self) -> FileStoreDataFrame:
+        return self.scan_file_store().collect().pipe(FileStoreDataFrame)
+
+    def scan_file_store(self, predicate: pl.Expr | None = None) -> pl.LazyFrame:
+        """
+        Lazily scan the filestore, including any delta segments, keeping only the rows matching predicate.
+        The predicate is pushed down to the parquet reader, which for a partitioned filestore means only the
+        matching type/run_id partitions are read. Filter through predicate rather than on the returned scan,
+        as merging in the deltas would otherwise stop the filter reaching the reader.
+        """
         assert self.file_store_path.exists(), (
             f"File store not found at {self.file_store_path}. Please build it via `build_filestore`"
         )
-        return pl.read_parquet(self.file_store_path).pipe(FileStoreDataFrame)
+        if self.partition_file_store:
+            lf = pl.scan_parquet(
+                self.file_store_path, hive_partitioning=True, hive_schema={"type": pl.String, "run_id": pl.String}
+            )
+        else:
+            lf = pl.scan_parquet(self.file_store_path)
+        if predicate is not None:
+            lf = lf.filter(predicate)
+        deltas = self.file_store_deltas
+        if deltas is None:
+            return lf
+        # A file in a delta replaces its row in the main filestore
+        lf = lf.join(deltas.lazy().select("file_path"), on="file_path", how="anti", maintain_order="left")
+        delta_lf = deltas.lazy() if predicate is None else deltas.lazy().filter(predicate)
+        return pl.concat([lf, delta_lf], how="diagonal_relaxed")
+
+    @cached_property
+    def file_store_deltas(self) -> pl.DataFrame | None:
+        """
+        The delta segments merged into one frame with a row per file, or None when there aren't any.
+        Deltas are small, so are read in full once rather than on every scan.
+        """
+        deltas = self.list_file_store_deltas()
+        self._loaded_deltas = deltas
+        if not deltas:
+            return None
+        # Deltas are named by creation time, so later segments win for the same file
+        df = pl.concat([pl.read_parquet(delta) for delta in deltas], how="diagonal_relaxed").unique(
+            "file_path", keep="last", maintain_order=True
+        )
+        if self.partition_file_store:
+            # Deltas hold the type as an enum, which doesn't mix with the string hive partition column
+            df = df.with_columns(pl.col("type").cast(pl.String))
+        return df
+
+    @cached_property
+    def file_store_delta_path(self) -> Path:
+        return self.file_store_path.with_name(f"{self.file_store_path.stem}_deltas")
+
+    @cached_property
+    def untyped_files_path(self) -> Path:
+        """
+        The fingerprints of files without a type, which aren't in the filestore but shouldn't be analysed every time.
+        """
+        return self.file_store_path.with_name(f"{self.file_store_path.stem}_untyped.parquet")
+
+    @cached_property
+    def file_store_versions_path(self) -> Path:
+        """
+        Where each write of a partitioned filestore goes, with the filestore path a symlink to the current one.
+        """
+        return self.file_store_path.with_name(f"{self.file_store_path.name}_versions")
+
+    @cached_property
+    def file_store_lock_path(self) -> Path:
+        return self.file_store_path.with_name(f".{self.file_store_path.name}.lock")
+
+    def is_file_store_path(self, path: Path) -> bool:
+        """
+        Whether a path is part of the filestore itself (the store, its partitions or its deltas).
+        """
+        return any(
+            path.is_relative_to(store_path)
+            for store_path in (
+                self.file_store_path,
+                self.file_store_versions_path,
+                self.file_store_lock_path,
+                self.file_store_delta_path,
+                self.untyped_files_path,
+            )
+        )
+
+    @contextmanager
+    def file_store_lock(self) -> Iterator[None]:
+        """
+        Hold an exclusive lock on the filestore, so only one process rewrites it at a time.
+        """
+        self.file_store_lock_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.file_store_lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def list_file_store_deltas(self) -> list[Path]:
+        if not self.file_store_delta_path.exists():
+            return []
+        return sorted(self.file_store_delta_path.glob("*.parquet"))
+
+    @cached_property
+    def file_store_index(self) -> FileStoreLookup:
+        # A partitioned filestore is never loaded in full, lookups are pushed down to the scan instead
+        if self.partition_file_store:
+            return FileStoreScan(self.scan_file_store)
+        return FileStoreIndex(self.file_store)
+
+    @cached_property
+    def detector_on_times(self) -> pl.DataFrame:
+        """
+        Every CCD on/off time parsed from the SNIFS run logs, loaded once and sorted by time within each channel,
+        ready for as-of lookups.
+        """
+        file_paths = self.file_store_index.of_type(FileType.CCD_ON_TIMES)["file_path"]
+        if file_paths.is_empty():
+            return pl.DataFrame(schema={"channel": pl.String, "time": pl.Datetime("ms", "UTC")})
+        return (
+            pl.read_parquet([self.data_path / file_path for file_path in file_paths])
+            .select("channel", "time")
+            .unique()
+            .sort("channel", "time")
+        )
 
     @cached_property
     def processed_data_path(self) -> Path:
         return self.data_path / "processed"
 
+    @cached_property
+    def product_store_path(self) -> Path:
+        return self.processed_data_path / "products"
+
+    @cached_property
+    def master_calibration_path(self) -> Path:
+        return self.product_store_path / "masters"
+
+    def product_store(self, file_path: Path) -> ProductStore:
+        """
+        The store for the intermediate products made from a file, laid out like the file under the data path.
+        """
+        return ProductStore(path=self.product_store_path / file_path.relative_to(self.data_path).with_suffix(""))
+
     @classmethod
     def create(cls, **kwargs) -> "Resolver":
-        kwargs = {"data_path": settings.data_path, "output_path": settings.output_path}
-        kwargs.update(kwargs)
+        kwargs = {"data_path": settings.data_path, "output_path": settings.output_path} | kwargs
+        kwargs.setdefault("partition_file_store", settings.partition_file_store)
         if "file_store_path" not in kwargs:
-            kwargs["file_store_path"] = kwargs["data_path"] / "filestore.parquet"
+            file_store_name = "filestore" if kwargs["partition_file_store"] else "filestore.parquet"
+            kwargs["file_store_path"] = kwargs["data_path"] / file_store_name
         return cls(**kwargs)
 
     def ensure_file_exists(self, file_path: Path) -> None:
-        file_store = self.file_store
-        entry = extract_file_details(file_path, file_path.relative_to(self.data_path))
+        self.ensure_files_exist([file_path])
 
-        # Get a hash of the dataframe as it exists now
-        current_hash = hash(tuple(file_store.drop("time_added").hash_rows().to_list()))
+    def ensure_files_exist(self, file_paths: list[Path]) -> None:
+        """
+        Register files in the filestore, skipping any that are already there and unchanged.
+        New and changed entries are appended in a single small delta segment next to the filestore,
+        rather than rewriting the whole thing. Deltas are compacted once there are too many of them.
+        """
+        assert not self.read_only, "Can't add files to the filestore through a read only resolver"
+        index = self.file_store_index
+        records = []
+        for file_path in file_paths:
+            relative_path = file_path.relative_to(self.data_path)
+            existing = index.get_row(str(relative_path))
+            if existing is not None:
+                fingerprint = tuple(existing.get(column) for column in FINGERPRINT_COLUMNS)
+                if fingerprint == file_fingerprint(file_path):
+                    continue
+            records.append(extract_file_record(file_path, relative_path))
+        if not records:
+            return
 
-        # add the entry to the dataframe and see if the hash has changed
-        new_file_store = (
-            pl.concat([file_store, entry], how="diagonal_relaxed", rechunk=True)
-            .sort("file_path", "time_added")
-            .unique("file_path", keep="last", maintain_order=True)
-        )
+        self.file_store_delta_path.mkdir(parents=True, exist_ok=True)
+        delta_path = self.file_store_delta_path / f"{time.time_ns()}-{os.getpid()}.parquet"
+        file_records_to_frame(records).pipe(FileStoreDataFrame).write_parquet(delta_path)
+        self.clear_cache()
 
-        # Get a hash of the new dataframe
-        new_hash = hash(tuple(file_store.drop("time_added").hash_rows().to_list()))
+        if len(self.list_file_store_deltas()) > self.max_file_store_deltas:
+            self.compact_filestore()
 
-        # If the hash has changed, we need to update the file store
-        if current_hash != new_hash:
-            # Save the new file store
-            self.save_filestore(FileStoreDataFrame(new_file_store))
+    def compact_filestore(self) -> None:
+        """
+        Fold any delta segments into the main filestore.
+        """
+        assert not self.read_only, "Can't compact the filestore through a read only resolver"
+        with self.file_store_lock():
+            # Deltas are read again under the lock, as another process may have compacted them while we waited
+            self.clear_cache()
+            if self.list_file_store_deltas():
+                self.write_filestore(self.file_store)
 
     def save_filestore(self, df: FileStoreDataFrame) -> None:
+        assert not self.read_only, "Can't save the filestore through a read only resolver"
+        with self.file_store_lock():
+            self.write_filestore(df)
+
+    def write_filestore(self, df: FileStoreDataFrame) -> None:
+        """
+        Replace the main filestore with df, removing the delta segments merged into it.
+        Readers always see either the old or the new filestore whole. Callers must hold the filestore lock.
+        """
         self.file_store_path.parent.mkdir(parents=True, exist_ok=True)
-        df.sort("file_path").write_parquet(self.file_store_path)
+        df = df.sort("file_path")
+        if self.partition_file_store:
+            self.write_partitioned_filestore(df)
+        else:
+            with atomic_write(self.file_store_path) as staging:
+                df.write_parquet(staging)
+        # Anything merged into the loaded filestore is now in the main file.
+        for delta in self._loaded_deltas:
+            delta.unlink(missing_ok=True)
+        self._loaded_deltas = []
+        self.clear_cache()
+
+    def write_partitioned_filestore(self, df: FileStoreDataFrame) -> None:
+        """
+        Write a new version of the partitioned filestore and point the filestore's symlink at it with a single
+        rename. The previous version is kept for any reader still scanning it, older ones are removed.
+        """
+        version_path = self.file_store_versions_path / str(time.time_ns())
+        df.with_columns(pl.col("type").cast(pl.String)).write_parquet(version_path, partition_by=["type", "run_id"])
+        link_path = staging_path(self.file_store_path)
+        link_path.symlink_to(version_path.relative_to(self.file_store_path.parent))
+        if self.file_store_path.is_dir() and not self.file_store_path.is_symlink():
+            # A filestore written before versions were kept, which is replaced in place this once
+            shutil.rmtree(self.file_store_path)
+        os.replace(link_path, self.file_store_path)
+        versions = sorted(self.file_store_versions_path.iterdir(), key=lambda path: int(path.name))
+        for old_version in versions[:-2]:
+            shutil.rmtree(old_version, ignore_errors=True)
 
-    def get_file_metadata(self, file_path: Path) -> FileStoreEntry:
+    def clear_cache(self) -> None:
+        """
+        Drop the cached filestore and index so the next access picks up what is on disk.
+        """
+        self.__dict__.pop("file_store", None)
+        self.__dict__.pop("file_store_deltas", None)
+        self.__dict__.pop("file_store_index", None)
+        self.__dict__.pop("detector_on_times", None)
+
+    def get_file_metadata(self, file_path: Path) -> FileStoreRecord:
         """
         Get the metadata for a file.
         """
-        if self.file_store is None:
+        if not self.file_store_exists():
             raise FileNotFoundError(f"File store not found at {self.file_store_path}.")
         relative_path = str(file_path.relative_to(self.data_path))
-        file_records = self.file_store.filter(pl.col("file_path").eq(relative_path))
-        if len(file_records) == 0:
+        # file_path is unique in the filestore, so the index holds at most one row per path
+        file_record = self.file_store_index.get_row(relative_path)
+        if file_record is None:
             raise FileNotFoundError(f"File {relative_path} not found in file store.")
-        assert len(file_records) == 1, f"Found multiple records for {relative_path}"
-        return FileStoreEntry.model_validate(file_records.to_dicts()[0])
+        return FileStoreRecord(**file_record)
 
     def get_match(
         self,
         file_type: str | FileType,
-        primary: FileStoreEntry | None,
-    ) -> FileStoreEntry:
+        primary: PrimaryFile | None,
+    ) -> FileStoreRecord:
         """
         Get a single match for a file type.
         """
         if isinstance(file_type, FileType):
             file_type = file_type.value
-        return file_match_registry.get_match(file_type, primary, self.file_store)
+        return file_match_registry.get_match(file_type, primary, self.file_store_index)
 
     def get_match_path(
         self,
         file_type: str | FileType,
-        primary: FileStoreEntry | None = None,
+        primary: PrimaryFile | None = None,
     ) -> Path:
         return self.data_path / self.get_match(file_type, primary).file_path
 
     def get_matches(
         self,
         file_type: str | FileType,
-        primary: FileStoreEntry | None = None,
-    ) -> list[FileStoreEntry]:
+        primary: PrimaryFile | None = None,
+    ) -> FileStoreRecords:
         """
         Get all matches for a file type.
         """
-        return file_match_registry.get_matches(file_type, primary, self.file_store)
+        return file_match_registry.get_matches(file_type, primary, self.file_store_index)
 
     def get_match_paths(
         self,
         file_type: str | FileType,
-        primary: FileStoreEntry | None = None,
+        primary: PrimaryFile | None = None,
     ) -> list[Path]:
         """
         Get all match paths for a file type.
         """
-        return [self.data_path / match.file_path for match in self.get_matches(file_type, primary)]
+        return [self.data_path / file_path for file_path in self.get_matches(file_type, primary).file_paths]
+
+    def get_batch_matches(
+        self,
+        file_type: str | FileType,
+        primaries: list[Path],
+    ) -> pl.DataFrame:
+        """
+        Get all matches for a file type for many primary files at once, as (primary_path, file_path) pairs.
+        Both columns are relative to the data path, like the filestore.
+        """
+        primary_rows = self.get_files_metadata(primaries)
+        return file_match_registry.get_batch_matches(file_type, primary_rows, self.file_store_index)
+
+    def get_files_metadata(self, file_paths: list[Path]) -> pl.DataFrame:
+        """
+        Get the filestore rows for many files at once, in the order given.
+        """
+        relative_paths = [str(file_path.relative_to(self.data_path)) for file_path in file_paths]
+        return self.file_store_index.get_rows(relative_paths)
+
+    def find_science_files(
+        self,
+        run_ids: list[str] | None = None,
+        start: dt | None = None,
+        end: dt | None = None,
+    ) -> list[Path]:
+        """
+        Find the science exposures from any of the given runs and observed between start (inclusive) and end
+        (exclusive), in observation order. Filters are pushed down to the filestore scan.
+        """
+        predicate = pl.col("type") == FileType.SCIENCE.value
+        if run_ids:
+            predicate &= pl.col("run_id").is_in(run_ids)
+        if start is not None:
+            predicate &= pl.col("time_observation") >= start
+        if end is not None:
+            predicate &= pl.col("time_observation") < end
+        lf = self.scan_file_store(predicate)
+        file_paths = lf.sort("time_observation", "file_path").select("file_path").collect()["file_path"]
+        return [self.data_path / file_path for file_path in file_paths]
+
+    def get_calibration_matches(self, science_files: list[Path]) -> pl.DataFrame:
+        """
+        Resolve the calibration files for many science files in one pass over the filestore.
+        Returns one row per science file with its arc, continuum (flat) and weather files, relative to the data path.
+        Science files without a match for a type get a null (or an empty list of continuum files).
+        """
+        science_rows = self.get_files_metadata(science_files)
+        calibrations = science_rows.select(pl.col("file_path").alias("science_file"))
+        for file_type, column, aggregation in [
+            (FileType.ARC, "arc_file", pl.col("file_path").first()),
+            (FileType.CONTINUUM, "continuum_files", pl.col("file_path")),
+            (FileType.WEATHER, "weather_file", pl.col("file_path").first()),
+        ]:
+            matches = (
+                file_match_registry.get_batch_matches(file_type, science_rows, self.file_store_index)
+                .group_by("primary_path", maintain_order=True)
+                .agg(aggregation.alias(column))
+            )
+            calibrations = calibrations.join(
+                matches, left_on="science_file", right_on="primary_path", how="left", maintain_order="left"
+            )
+        return calibrations.with_columns(pl.col("continuum_files").fill_null([]))
+
+    def get_detector_last_on_times(self, science_files: list[Path]) -> pl.DataFrame:
+        """
+        The last time the detector was turned on or off before each science file was observed, for many science
+        files at once with a single as-of join on the science file's channel. Returns one row per science file,
+        in the order given, with a null time where the run logs have nothing earlier for its channel.
+        """
+        science_rows = (
+            self.get_files_metadata(science_files)
+            .with_row_index()
+            .select(
+                "index",
+                pl.col("file_path").alias("science_file"),
+                # The run logs only have the first letter of the channel (B or R)
+                pl.col("channel").str.slice(0, 1).str.to_uppercase().alias("channel"),
+                "time_observation",
+            )
+            .sort("time_observation")
+        )
+        return (
+            science_rows.join_asof(
+                self.detector_on_times.rename({"time": "detector_last_on_time"}),
+                left_on="time_observation",
+                right_on="detector_last_on_time",
+                by="channel",
+                strategy="backward",
+                allow_exact_matches=False,
+                check_sortedness=False,
+            )
+            .sort("index")
+            .select("science_file", "detector_last_on_time")
+        )
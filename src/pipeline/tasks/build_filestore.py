@@ -1,49 +1,138 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
 import polars as pl
 
-from pipeline.common.log import get_logger
+from pipeline.common.log import get_logger, setup_logging
 from pipeline.common.prefect_utils import pipeline_task
-from pipeline.resolver.common import FileStoreDataFrame, extract_file_details
+from pipeline.config.global_settings import settings
+from pipeline.resolver.common import (
+    FINGERPRINT_COLUMNS,
+    FileRecord,
+    FileStoreDataFrame,
+    extract_file_record,
+    file_fingerprint,
+    file_records_to_frame,
+)
 from pipeline.resolver.resolver import Resolver
 
 
+def extract_all_file_records(files: list[Path], relative_paths: list[Path], max_workers: int = 1) -> list[FileRecord]:
+    """
+    Extract the records for many files, fanning out over a process pool when max_workers > 1.
+    Results are returned in the same order as the input files, so the output matches a serial run.
+    """
+    if max_workers <= 1 or len(files) <= 1:
+        return [extract_file_record(file, path) for file, path in zip(files, relative_paths, strict=True)]
+
+    # Hand each worker a decent chunk of files to amortise the pickling overhead
+    # Spawn rather than fork, as forking while polars' thread pool is running can deadlock
+    chunksize = max(1, len(files) // (max_workers * 8))
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+        return list(executor.map(extract_file_record, files, relative_paths, chunksize=chunksize))
+
+
+def load_analysed_files(resolver: Resolver, file_store: FileStoreDataFrame) -> list[pl.DataFrame]:
+    """
+    Every file analysed so far, the filestore plus the fingerprints of the files without a type,
+    which aren't in the filestore but still shouldn't be analysed again until they change.
+    """
+    if not resolver.untyped_files_path.exists():
+        return [file_store]
+    return [file_store, pl.read_parquet(resolver.untyped_files_path)]
+
+
+def is_data_file(resolver: Resolver, file: Path) -> bool:
+    """
+    Whether a file found in the data path belongs in the filestore.
+    """
+    if file.is_dir():
+        return False
+    if file.suffix == ".md":
+        return False
+    # Like parquet datasets, files starting with an underscore or dot are metadata (such as fetch state)
+    if file.name.startswith(("_", ".")):
+        return False
+    if resolver.is_file_store_path(file):
+        return False
+    # Intermediate products are only ever reached through their handles
+    return not file.is_relative_to(resolver.product_store_path)
+
+
 @pipeline_task()
-def build_filestore(refresh: bool = False) -> Resolver:
+def build_filestore(refresh: bool = False, max_workers: int | None = None) -> Resolver:
     resolver = Resolver.create()
+    max_workers = settings.filestore_workers if max_workers is None else max_workers
 
     logger = get_logger()
     file_store = resolver.file_store if resolver.file_store_exists() else None
-    analysed_files = [] if file_store is None else file_store["file_path"].to_list()
 
-    dfs = [] if file_store is None or refresh else [file_store]
+    dfs = [] if file_store is None or refresh else load_analysed_files(resolver, file_store)
+    # Map each known file onto its fingerprint so unchanged files can be skipped with a single dict lookup.
+    # Stores written before fingerprints were recorded have nulls here, so those files are re-analysed once.
+    analysed_files: dict[str, tuple[int, int, int]] = {}
+    for df in dfs:
+        fingerprints = df.select(
+            "file_path", *[pl.col(c) if c in df.columns else pl.lit(None).alias(c) for c in FINGERPRINT_COLUMNS]
+        )
+        analysed_files |= {path: tuple(fingerprint) for path, *fingerprint in fingerprints.iter_rows()}
 
     # If files are deleted, we want to reflect this as well.
-    detected_filepaths = []
-    all_files = list(resolver.data_path.rglob("*/**/*"))
+    detected_filepaths = set()
+    files_to_extract, relative_paths_to_extract = [], []
+    # Data sits in directories below the data path, so anything directly in it is skipped. A pattern like "*/**/*"
+    # would match deeper files once per directory above them, so walk everything once and filter instead.
+    all_files = [file for file in resolver.data_path.rglob("*") if file.parent != resolver.data_path]
     logger.info(f"Found {len(all_files)} files in the data path. Rebuilding the filestore.")
     for file in all_files:
-        if file.is_dir():
-            continue
-        if file.suffix == ".md":
+        if not is_data_file(resolver, file):
             continue
         relative_path = file.relative_to(resolver.data_path)
-        detected_filepaths.append(str(relative_path))
-        if refresh or relative_path not in analysed_files:
-            dfs.append(extract_file_details(file, relative_path))
+        # Each file is queued at most once, however many times the walk reaches it (such as through a symlink)
+        if str(relative_path) in detected_filepaths:
+            continue
+        detected_filepaths.add(str(relative_path))
+        if refresh or analysed_files.get(str(relative_path)) != file_fingerprint(file):
+            files_to_extract.append(file)
+            relative_paths_to_extract.append(relative_path)
+
+    removed_files = analysed_files.keys() - detected_filepaths
+    if file_store is not None and not refresh and not files_to_extract and not removed_files:
+        logger.info(f"No new, changed or removed files found. Filestore at {resolver.file_store_path} is up to date.")
+        return resolver
+    logger.info(f"Found {len(files_to_extract)} new or changed files and {len(removed_files)} removed files.")
+
+    start = time.perf_counter()
+    records = extract_all_file_records(files_to_extract, relative_paths_to_extract, max_workers=max_workers)
+    elapsed = time.perf_counter() - start
+    rate = len(files_to_extract) / elapsed if elapsed > 0 else 0.0
+    logger.info(
+        f"Extracted details from {len(files_to_extract)} files in {elapsed:.2f}s "
+        f"({rate:.1f} files/s) using {max_workers} worker(s)"
+    )
+    dfs.append(file_records_to_frame(records))
 
-    df = (
+    all_records = (
         pl.concat(dfs, how="diagonal_relaxed", rechunk=True)
         .sort("time_added")
         .unique(subset=["file_path"], keep="last", maintain_order=True)
-        .filter(pl.col("file_path").is_in(detected_filepaths))
-        .drop_nulls(subset=["type"])
-        .pipe(FileStoreDataFrame)
+        .filter(pl.col("file_path").is_in(list(detected_filepaths)))
     )
+    untyped = all_records.filter(pl.col("type").is_null()).select("file_path", *FINGERPRINT_COLUMNS)
+    # The only schema validation, done once over the final table
+    df = all_records.drop_nulls(subset=["type"]).pipe(FileStoreDataFrame)
     logger.info(f"Writing filestore with shape {df.shape} to {resolver.file_store_path}")
     resolver.save_filestore(df)
+    resolver.untyped_files_path.parent.mkdir(parents=True, exist_ok=True)
+    untyped.write_parquet(resolver.untyped_files_path)
     # Validate the file store exists and can be loaded
     _ = resolver.file_store
     return resolver
 
 
 if __name__ == "__main__":
+    setup_logging()
     build_filestore(refresh=True)
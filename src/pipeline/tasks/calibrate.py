@@ -1,6 +1,7 @@
 from pipeline.common.prefect_utils import pipeline_task
+from pipeline.common.products import ProductHandle
 
 
 @pipeline_task()
-def calibrate_with_flats():
+def calibrate_with_flats(master_flat: ProductHandle | None = None):
     pass
@@ -1,15 +1,22 @@
+import hashlib
 from datetime import datetime as dt
 from datetime import timedelta as td
 from datetime import timezone as tz
+from functools import cache
 from pathlib import Path
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 
 import pandera as pa
 import polars as pl
 from pandera.polars import DataFrameModel
 from pandera.typing.polars import DataFrame, Series
+from pydantic import BaseModel
 
-from pipeline.common.log import get_logger
+from pipeline.common.files import JsonState, atomic_write, file_fingerprint
+from pipeline.common.log import get_logger, setup_logging
 from pipeline.common.prefect_utils import pipeline_task
+from pipeline.config.global_settings import settings
 from pipeline.resolver.common import UTCDatetime
 from pipeline.resolver.resolver import Resolver
 
@@ -25,44 +32,391 @@ class Weather(DataFrameModel):
 
 WeatherDataFrame = DataFrame[Weather]
 
+# Where the weather lives relative to the data path, partitioned into year=YYYY/month=MM under it
+WEATHER_STORE_PATH = Path("misc/type=WEATHER/station=CFHT")
+WEATHER_PARTITION_NAME = "weather.parquet"
+# Metadata files start with an underscore, so the filestore leaves them alone
+WEATHER_FETCH_STATE_NAME = "_fetch_state.json"
+WEATHER_MANIFEST_NAME = "_manifest.json"
+# Conditions which vary smoothly enough to interpolate between data points
+INTERPOLATED_COLUMNS = ["wind_speed", "temperature", "relative_humidity", "pressure"]
 
-def should_fetch_data(path: Path) -> bool:
-    if not path.exists():
+
+@cache
+def weather_dtypes() -> dict[str, pl.DataType]:
+    return {column: field.dtype.type for column, field in Weather.to_schema().columns.items()}
+
+
+class WeatherManifest(BaseModel):
+    """
+    A small summary of the weather store, so checking how up to date it is never means reading it.
+    """
+
+    latest_time: dt | None
+    # The partition holding the latest data, and its fingerprint, so a manifest left behind by other data is ignored
+    latest_partition: str
+    fingerprint: tuple[int, int, int]
+
+
+class WeatherStore:
+    """
+    Weather data partitioned by the (UTC) year and month of each data point.
+
+    New data is validated on its own and merged into just the partitions it falls in, so the cost of an update
+    depends on how much data is new, not how much history there is. Reads only open the partitions covering the
+    requested time span.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.path / WEATHER_MANIFEST_NAME
+
+    @property
+    def legacy_path(self) -> Path:
+        # Before partitioning, everything was kept in a single file
+        return self.path / WEATHER_PARTITION_NAME
+
+    def partition_path(self, year: int, month: int) -> Path:
+        return self.path / f"year={year}" / f"month={month:02d}" / WEATHER_PARTITION_NAME
+
+    def partitions(self) -> list[Path]:
+        # Years and months are zero padded, so this is time order
+        return sorted(self.path.glob(f"year=*/month=*/{WEATHER_PARTITION_NAME}"))
+
+    def exists(self) -> bool:
+        return bool(self.partitions())
+
+    def clear(self) -> None:
+        for partition in self.partitions():
+            partition.unlink()
+        self.manifest_path.unlink(missing_ok=True)
+
+    def scan(self, start: dt | None = None, end: dt | None = None) -> pl.LazyFrame:
+        """
+        Lazily scan the weather between start (inclusive) and end (exclusive), opening only the partitions they span.
+        """
+        partitions = self.partitions()
+        if start is not None:
+            partitions = [p for p in partitions if p >= self.partition_path(start.year, start.month)]
+        if end is not None:
+            partitions = [p for p in partitions if p <= self.partition_path(end.year, end.month)]
+        if not partitions:
+            return pl.LazyFrame(schema=weather_dtypes())
+
+        lf = pl.concat([pl.scan_parquet(partition) for partition in partitions], how="diagonal_relaxed")
+        if start is not None:
+            lf = lf.filter(pl.col("time") >= start)
+        if end is not None:
+            lf = lf.filter(pl.col("time") < end)
+        return lf
+
+    def append(self, df: pl.DataFrame) -> int:
+        """
+        Add new weather data, rewriting only the partitions it falls in. Returns the number of partitions written.
+        Only the new rows are validated, existing partitions were validated when they were written.
+        """
+        df = WeatherDataFrame(df.sort("time").unique("time", keep="last", maintain_order=True))
+        num_partitions = 0
+        for (year, month), new_rows in df.group_by(
+            pl.col("time").dt.year().alias("year"), pl.col("time").dt.month().alias("month")
+        ):
+            path = self.partition_path(year, month)  # type: ignore
+            partition = new_rows
+            if path.exists():
+                partition = pl.concat([pl.read_parquet(path), new_rows], how="diagonal_relaxed")
+            partition = partition.sort("time").unique("time", keep="last", maintain_order=True)
+            # Write then rename, so a partial write is never picked up as data
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with atomic_write(path) as staging:
+                partition.write_parquet(staging)
+            num_partitions += 1
+        self.update_manifest()
+        return num_partitions
+
+    def migrate_legacy(self) -> None:
+        """
+        Move weather kept in the old single file into partitions.
+        """
+        if self.legacy_path.exists():
+            self.append(pl.read_parquet(self.legacy_path))
+            self.legacy_path.unlink()
+
+    def update_manifest(self) -> WeatherManifest | None:
+        partitions = self.partitions()
+        if not partitions:
+            self.manifest_path.unlink(missing_ok=True)
+            return None
+        latest_partition = partitions[-1]
+        manifest = WeatherManifest(
+            latest_time=pl.scan_parquet(latest_partition).select(pl.col("time").max()).collect().item(),
+            latest_partition=str(latest_partition.relative_to(self.path)),
+            fingerprint=file_fingerprint(latest_partition),
+        )
+        with atomic_write(self.manifest_path) as staging:
+            staging.write_text(manifest.model_dump_json(indent=2))
+        return manifest
+
+    def latest_time(self) -> dt | None:
+        """
+        The time of the latest weather data point, from the manifest when it is current.
+        Otherwise the latest partition's time column is scanned, and the manifest rebuilt for next time.
+        """
+        if self.manifest_path.exists():
+            manifest = WeatherManifest.model_validate_json(self.manifest_path.read_text())
+            latest_partition = self.path / manifest.latest_partition
+            if latest_partition.exists() and manifest.fingerprint == file_fingerprint(latest_partition):
+                return manifest.latest_time
+        manifest = self.update_manifest()
+        return None if manifest is None else manifest.latest_time
+
+    def attach(
+        self,
+        df: pl.DataFrame,
+        on: str = "time_observation",
+        tolerance: td = td(minutes=10),
+        interpolate: bool = False,
+    ) -> pl.DataFrame:
+        """
+        Attach the weather at each row's time, for any number of rows in one sorted as-of join.
+
+        By default this is the latest weather at or before each time, no more than tolerance before it.
+        With interpolate, numeric conditions are linearly interpolated between the data points either side,
+        where both are within tolerance, falling back to the prior point otherwise. Wind direction is circular,
+        so it is always taken from the prior point. Rows without weather in range get nulls.
+        Rows keep their order, with the matched point's time added as weather_time.
+        """
+        key = "__weather_key"
+        row = "__weather_row"
+        df = df.with_row_index(row).with_columns(
+            pl.col(on).dt.cast_time_unit("ms").dt.convert_time_zone("UTC").alias(key)
+        )
+        times = df[key].drop_nulls()
+        if times.is_empty():
+            weather = pl.DataFrame(schema=weather_dtypes())
+        else:
+            # Only the span covered by the rows is read, padded so the points either side are included
+            start, end = times.min() - tolerance, times.max() + tolerance  # type: ignore
+            weather = self.scan(start=start, end=end + td(milliseconds=1)).collect().sort("time")
+
+        result = df.sort(key, nulls_last=True).join_asof(
+            weather.rename({"time": "weather_time"}),
+            left_on=key,
+            right_on="weather_time",
+            strategy="backward",
+            tolerance=tolerance,
+        )
+        if interpolate:
+            following = weather.select(
+                pl.col("time").alias("__next_time"), *[pl.col(c).alias(f"__next_{c}") for c in INTERPOLATED_COLUMNS]
+            )
+            result = result.join_asof(
+                following, left_on=key, right_on="__next_time", strategy="forward", tolerance=tolerance
+            )
+            span = (pl.col("__next_time") - pl.col("weather_time")).dt.total_milliseconds()
+            fraction = pl.when(span > 0).then((pl.col(key) - pl.col("weather_time")).dt.total_milliseconds() / span)
+            result = result.with_columns(
+                pl.coalesce(
+                    pl.col(c) + (pl.col(f"__next_{c}") - pl.col(c)) * fraction, pl.col(c).cast(pl.Float64)
+                ).alias(c)
+                for c in INTERPOLATED_COLUMNS
+            ).drop(pl.selectors.starts_with("__next_"))
+        return result.sort(row).drop(row, key)
+
+    def lookup(
+        self,
+        times: pl.Series | list[dt],
+        tolerance: td = td(minutes=10),
+        interpolate: bool = False,
+    ) -> pl.DataFrame:
+        """
+        The weather at each of the given times, in the same order. See `attach`.
+        """
+        df = pl.DataFrame({"time_observation": times}).cast({"time_observation": weather_dtypes()["time"]})
+        return self.attach(df, tolerance=tolerance, interpolate=interpolate)
+
+
+def get_weather_store(resolver: Resolver) -> WeatherStore:
+    return WeatherStore(resolver.data_path / WEATHER_STORE_PATH)
+
+
+def should_fetch_data(store: WeatherStore) -> bool:
+    if not store.exists():
         return True
     expect_datapoint_after = dt.now(tz=tz.utc) - td(minutes=5)
-    df = pl.read_parquet(path).filter(pl.col("time") > expect_datapoint_after)
-    if df.is_empty():
-        return True
-    return False
+    latest_time = store.latest_time()
+    return latest_time is None or latest_time <= expect_datapoint_after
+
+
+def decimate_min_max(df: pl.DataFrame, column: str, num_buckets: int) -> pl.DataFrame:
+    """
+    Thin a time series down to the minimum and maximum point in each of num_buckets equal time buckets.
+    With a bucket per pixel column the plotted line looks the same, peaks and all, from far fewer points.
+    """
+    if len(df) <= 2 * num_buckets:
+        return df
+    epoch = pl.col("time").dt.epoch("ms")
+    bucket = (epoch - epoch.min()) * num_buckets // (epoch.max() - epoch.min() + 1)
+    return (
+        df.with_columns(bucket.alias("bucket"))
+        .filter(
+            pl.col(column).eq(pl.col(column).min().over("bucket"))
+            | pl.col(column).eq(pl.col(column).max().over("bucket"))
+        )
+        .unique(["bucket", column], keep="first", maintain_order=True)
+        .drop("bucket")
+    )
 
 
 def plot_weather_data(
     df: WeatherDataFrame,
     plot_output_directory: Path,
     plot_lookback_days: int = 30,
+    dpi: int = 300,
 ) -> None:
-    import matplotlib.pyplot as plt
+    from matplotlib.figure import Figure
 
     plot_output_directory.mkdir(parents=True, exist_ok=True)
+    output_path = plot_output_directory / "cfht_weather.png"
+    fingerprint_path = output_path.with_name(f".{output_path.name}.fingerprint")
+    logger = get_logger()
 
+    # Start on the hour, so the plotted data (and so its fingerprint) only changes when new data comes in
     now = dt.now(tz=tz.utc)
-    lookback_time = now - td(days=plot_lookback_days)
+    lookback_time = (now - td(days=plot_lookback_days)).replace(minute=0, second=0, microsecond=0)
     df2 = df.filter(pl.col("time").is_between(lookback_time, now))
 
+    hasher = hashlib.blake2b(f"{plot_lookback_days}:{dpi}:{df2.columns}".encode(), digest_size=20)
+    hasher.update(df2.hash_rows().to_numpy().tobytes())
+    fingerprint = hasher.hexdigest()
+    if output_path.exists() and fingerprint_path.exists() and fingerprint_path.read_text() == fingerprint:
+        logger.info(f"Weather plot at {output_path} is already up to date. Not plotting.")
+        return
+
     cols_to_plot = ["temperature", "wind_speed", "wind_direction", "relative_humidity", "pressure"]
-    fig, ax = plt.subplots(len(cols_to_plot), 1, figsize=(10, 8), sharex=True)
+    # A figure outside of pyplot is never registered with a GUI backend, and is safe to use across threads
+    fig = Figure(figsize=(10, 8), dpi=dpi)
+    ax = fig.subplots(len(cols_to_plot), 1, sharex=True)
+    # A min and max point for every two pixel columns, so there are never more points than pixels across
+    num_buckets = max(1, int(ax[0].get_window_extent().width) // 2)
     for i, col in enumerate(cols_to_plot):
-        df_sub = df2.select("time", col).drop_nulls()
+        df_sub = decimate_min_max(df2.select("time", col).drop_nulls(), col, num_buckets)
         ax[i].plot(df_sub["time"], df_sub[col], label=col)
         ax[i].set_ylabel(col)
     ax[-1].set_xlabel("Time")
     ax[0].set_title("Weather Data from CFHT")
 
-    logger = get_logger()
-    output_path = plot_output_directory / "cfht_weather.png"
     logger.info(f"Plotting a month's worth of data to {output_path}")
-    fig.savefig(output_path, dpi=300, bbox_inches="tight")
-    plt.close(fig)
+    fig.savefig(output_path, dpi=dpi, bbox_inches="tight")
+    fingerprint_path.write_text(fingerprint)
+
+
+class WeatherSourceState(BaseModel):
+    # How far into the source we've parsed, always at the end of a complete line
+    offset: int = 0
+    last_modified: str | None = None
+
+
+class WeatherFetchState(JsonState):
+    sources: dict[str, WeatherSourceState] = {}
+
+
+def fetch_new_bytes(source: str, state: WeatherSourceState) -> tuple[bytes, WeatherSourceState]:
+    """
+    Fetch whatever has been appended to a weather source since it was last read.
+    HTTP sources are asked for just the new bytes with Range/If-Modified-Since, anything else is read as a local file.
+    Only complete lines are returned, with the state moved on to the end of them.
+    """
+    if source.startswith(("http://", "https://")):
+        data, last_modified = fetch_http_range(source, state)
+    else:
+        data, last_modified = read_file_range(Path(source.removeprefix("file://")), state)
+    if data is None:
+        # The source was replaced by something shorter, so start over from the beginning of it
+        return fetch_new_bytes(source, WeatherSourceState())
+
+    complete = data[: data.rfind(b"\n") + 1]
+    return complete, WeatherSourceState(offset=state.offset + len(complete), last_modified=last_modified)
+
+
+def fetch_http_range(url: str, state: WeatherSourceState) -> tuple[bytes | None, str | None]:
+    headers = {"Range": f"bytes={state.offset}-"}
+    if state.last_modified is not None:
+        headers["If-Modified-Since"] = state.last_modified
+    try:
+        with urlopen(Request(url, headers=headers), timeout=30) as response:
+            last_modified = response.headers.get("Last-Modified")
+            data = response.read()
+            if response.status == 200:
+                # The server ignored the range and sent the whole thing
+                if len(data) < state.offset:
+                    return None, last_modified
+                data = data[state.offset :]
+            return data, last_modified
+    except HTTPError as e:
+        if e.code == 304:
+            return b"", state.last_modified
+        if e.code == 416:
+            # Nothing past our offset. A source shorter than our offset has been replaced.
+            size = e.headers.get("Content-Range", "").rpartition("/")[2]
+            if size.isdigit() and int(size) < state.offset:
+                return None, None
+            return b"", state.last_modified
+        raise
+
+
+def read_file_range(path: Path, state: WeatherSourceState) -> tuple[bytes | None, str | None]:
+    if not path.exists():
+        return b"", state.last_modified
+    if path.stat().st_size < state.offset:
+        return None, None
+    with open(path, "rb") as f:
+        f.seek(state.offset)
+        return f.read(), state.last_modified
+
+
+def parse_cfht_weather(data: bytes) -> pl.DataFrame:
+    """
+    Parse lines of a CFHT weather archive file.
+    Types are given rather than inferred, as a few newly fetched lines may happen to only hold whole numbers.
+    """
+    return (
+        pl.read_csv(
+            data,
+            has_header=False,
+            separator=" ",
+            schema_overrides={column: dtype for column, dtype in weather_dtypes().items() if column != "time"},
+            new_columns=[
+                "year",
+                "month",
+                "day",
+                "hour",
+                "minute",
+                "wind_speed",
+                "wind_direction",
+                "temperature",
+                "relative_humidity",
+                "pressure",
+            ],
+        )
+        .with_columns(
+            pl.datetime(
+                year=pl.col("year"),
+                month=pl.col("month"),
+                day=pl.col("day"),
+                hour=pl.col("hour"),
+                minute=pl.col("minute"),
+                time_unit="ms",
+                time_zone="HST",
+            )
+            .dt.convert_time_zone("UTC")
+            .alias("time")
+        )
+        .drop("year", "month", "day", "hour", "minute", pl.selectors.starts_with("column"))
+        .select("time", pl.all().exclude("time"))
+    )
 
 
 @pipeline_task()
@@ -72,68 +426,51 @@ def update_cfht_weather(
     make_plots: bool = False,
 ) -> None:
     resolver = Resolver.create()
-    expected_location = resolver.data_path / "misc/type=WEATHER/station=CFHT/weather.parquet"
+    store = get_weather_store(resolver)
+    state_location = store.path / WEATHER_FETCH_STATE_NAME
     logger = get_logger()
-    if should_fetch_data(expected_location):
+    store.migrate_legacy()
+    if should_fetch_data(store):
         logger.info("Fetching CFHT weather data")
         now = dt.now(tz=tz.utc)
         lookback_time = now - td(days=lookback_time_days)
-        years_to_fetch = {lookback_time.year, now.year}
-        dfs = []
-        if not refresh and expected_location.exists():
-            dfs.append(pl.read_parquet(expected_location))
+        years_to_fetch = sorted({lookback_time.year, now.year})
+        # Without any weather to add to, anything fetched before has to be fetched again
+        fetch_state = WeatherFetchState()
+        if refresh:
+            store.clear()
+        elif store.exists():
+            fetch_state = WeatherFetchState.load(state_location)
 
+        dfs = []
+        fetched_bytes = 0
         for year in years_to_fetch:
-            url = f"http://mkwc.ifa.hawaii.edu/archive/wx/cfht/cfht-wx.{year}.dat"
-            logger.info(f"Fetching weather data from {url}")
-            df = (
-                pl.read_csv(
-                    url,
-                    has_header=False,
-                    separator=" ",
-                    new_columns=[
-                        "year",
-                        "month",
-                        "day",
-                        "hour",
-                        "minute",
-                        "wind_speed",
-                        "wind_direction",
-                        "temperature",
-                        "relative_humidity",
-                        "pressure",
-                    ],
-                )
-                .with_columns(
-                    pl.datetime(
-                        year=pl.col("year"),
-                        month=pl.col("month"),
-                        day=pl.col("day"),
-                        hour=pl.col("hour"),
-                        minute=pl.col("minute"),
-                        time_unit="ms",
-                        time_zone="HST",
-                    )
-                    .dt.convert_time_zone("UTC")
-                    .alias("time")
-                )
-                .drop("year", "month", "day", "hour", "minute", pl.selectors.starts_with("column"))
-                .select("time", pl.all().exclude("time"))
-            )
-            dfs.append(df)
-        df = WeatherDataFrame(
-            pl.concat(dfs, how="diagonal_relaxed").sort("time").unique("time", keep="last", maintain_order=True)
-        )
-        expected_location.parent.mkdir(parents=True, exist_ok=True)
-        df.write_parquet(expected_location)
+            source = settings.cfht_weather_source.format(year=year)
+            source_state = fetch_state.sources.get(source, WeatherSourceState())
+            logger.info(f"Fetching weather data from {source} after byte {source_state.offset}")
+            data, fetch_state.sources[source] = fetch_new_bytes(source, source_state)
+            fetched_bytes += len(data)
+            if data:
+                dfs.append(parse_cfht_weather(data))
+        logger.info(f"Fetched {fetched_bytes} bytes of new weather data")
+
+        store.path.mkdir(parents=True, exist_ok=True)
+        if dfs:
+            num_partitions = store.append(pl.concat(dfs, how="diagonal_relaxed"))
+            logger.info(f"Added {sum(len(df) for df in dfs)} rows of weather data across {num_partitions} partition(s)")
+        # Only move the offsets on once the data up to them is safely stored
+        fetch_state.save(state_location)
     else:
-        logger.info(f"Weather data already exists at {expected_location} and is up to date. Not fetching.")
+        logger.info(f"Weather data already exists at {store.path} and is up to date. Not fetching.")
 
     if make_plots:
-        plot_weather_data(WeatherDataFrame(pl.read_parquet(expected_location)), resolver.output_path)
+        # Only read the month of data that gets plotted
+        lookback_time = dt.now(tz=tz.utc) - td(days=30)
+        plot_weather_data(WeatherDataFrame(store.scan(start=lookback_time).collect()), resolver.output_path)
 
 
 if __name__ == "__main__":
+    setup_logging()
     update_cfht_weather.fn(
         lookback_time_days=60,
         refresh=True,
@@ -1,11 +1,104 @@
 from pathlib import Path
+from types import TracebackType
 
 import numpy as np
 from astropy.io import fits
-from astropy.io.fits import Header
+from astropy.io.fits import CompImageHDU, Header
 
+from pipeline.common.files import file_fingerprint
 from pipeline.common.log import get_logger
 from pipeline.common.prefect_utils import pipeline_task
+from pipeline.common.products import ProductHandle, ProductStore
+
+# FITS image data is stored big endian, with the type given by BITPIX
+BITPIX_DTYPES = {8: "u1", 16: ">i2", 32: ">i4", 64: ">i8", -32: ">f4", -64: ">f8"}
+
+
+class FitsFile:
+    """
+    A FITS file that is opened once and memory mapped.
+
+    Headers are read from the already open file, and HDU data is handed out as read only views onto the
+    memory map, so later stages share the data on disk rather than each getting their own copy.
+    Data is only copied when a stage writes a new array, or when it has to be decoded into the product store.
+    Views stay valid after the file is closed.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.hdul = fits.open(path, memmap=True, mode="readonly")  # type: ignore
+        self.disk_formats: dict[int, tuple[int, float, float]] = {}
+
+    def __enter__(self) -> "FitsFile":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.hdul.close()
+
+    def check_hdu(self, hdu_index: int) -> None:
+        assert len(self.hdul) > hdu_index, f"FITS file {self.path} does not have HDU {hdu_index}"
+
+    def disk_format(self, hdu_index: int) -> tuple[int, float, float]:
+        """
+        The BITPIX, BSCALE and BZERO of an HDU's data as stored on disk.
+        These are read from the header before the data is first accessed, as astropy rewrites them once it scales
+        the data.
+        """
+        if hdu_index not in self.disk_formats:
+            header: Header = self.hdul[hdu_index].header
+            self.disk_formats[hdu_index] = (header["BITPIX"], header.get("BSCALE", 1), header.get("BZERO", 0))
+        return self.disk_formats[hdu_index]
+
+    def header(self, hdu_index: int = 0) -> dict[str, str | bool | int | float]:
+        self.check_hdu(hdu_index)
+        header: Header = self.hdul[hdu_index].header
+        return {k: v for k, v in header.items() if v is not None}
+
+    def data(self, hdu_index: int = 0) -> np.ndarray:
+        self.check_hdu(hdu_index)
+        self.disk_format(hdu_index)
+        data = self.hdul[hdu_index].data
+        view = data.view()
+        view.flags.writeable = False
+        return view
+
+    def product(self, hdu_index: int, store: ProductStore, name: str) -> ProductHandle:
+        """
+        A handle onto HDU data for passing between tasks.
+        Unscaled, uncompressed data is referenced where it sits in the FITS file, anything else is stored as a product.
+        """
+        self.check_hdu(hdu_index)
+        hdu = self.hdul[hdu_index]
+        bitpix, bscale, bzero = self.disk_format(hdu_index)
+        if not isinstance(hdu, CompImageHDU) and bscale == 1 and bzero == 0:
+            return ProductHandle(
+                path=self.path,
+                dtype=BITPIX_DTYPES[bitpix],
+                shape=hdu.shape,
+                offset=hdu.fileinfo()["datLoc"],
+                fingerprint=file_fingerprint(self.path),
+                metadata={"hdu_index": hdu_index},
+            )
+        # Reuse the stored copy if the FITS file hasn't changed since it was made
+        source = {
+            "source": str(self.path),
+            "source_fingerprint": list(file_fingerprint(self.path)),
+            "hdu_index": hdu_index,
+        }
+        existing = store.get(name)
+        if existing is not None and existing.metadata == source:
+            return existing
+        # Scaled or compressed data has to be decoded, which astropy won't do through a memory map
+        with fits.open(self.path, memmap=False) as hdul:  # type: ignore
+            return store.put(name, hdul[hdu_index].data, **source)
 
 
 @pipeline_task()
@@ -14,19 +107,19 @@ def load_header(science_file: Path, hdu_index: int = 0) -> dict[str, str | bool
     Load the primary header of a FITS file.
     """
     logger = get_logger()
-    with fits.open(science_file) as hdul:  # type: ignore
-        assert len(hdul) > hdu_index, f"FITS file {science_file} does not have HDU {hdu_index}"
-        header: Header = hdul[hdu_index].header
-        result = {k: v for k, v in header.items() if v is not None}
-        logger.debug(f"Loaded header from {science_file} with {len(result)} keys")
-        return result
+    with FitsFile(science_file) as fits_file:
+        result = fits_file.header(hdu_index)
+    logger.debug(f"Loaded header from {science_file} with {len(result)} keys")
+    return result
 
 
 @pipeline_task()
 def load_image_data(science_file: Path, hdu_index: int = 0) -> np.ndarray:
+    """
+    Load the data of a FITS HDU as a read only, memory mapped array.
+    """
     logger = get_logger()
-    with fits.open(science_file) as hdul:  # type: ignore
-        assert len(hdul) > hdu_index, f"FITS file {science_file} does not have HDU {hdu_index}"
-        data = hdul[hdu_index].data
-        logger.debug(f"Loaded image data from {science_file} with shape {data.shape} and dtype {data.dtype}")
-        return data
+    with FitsFile(science_file) as fits_file:
+        data = fits_file.data(hdu_index)
+    logger.debug(f"Loaded image data from {science_file} with shape {data.shape} and dtype {data.dtype}")
+    return data
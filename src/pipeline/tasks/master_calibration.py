@@ -0,0 +1,136 @@
+import fcntl
+import hashlib
+import tempfile
+import threading
+from collections import Counter
+from functools import cache
+from pathlib import Path
+
+import numpy as np
+
+from pipeline.common.files import file_fingerprint
+from pipeline.common.log import get_logger
+from pipeline.common.prefect_utils import pipeline_task
+from pipeline.common.products import CHUNK_BYTES, ProductHandle, ProductStore
+from pipeline.resolver.common import FileType
+from pipeline.resolver.resolver import Resolver
+from pipeline.tasks.common import FitsFile
+
+# Bump this whenever the way frames are combined changes, so stale masters are rebuilt
+COMBINE_VERSION = 2
+MASTER_NAME = "master"
+# Frames are normalised by the median of about this many of their pixels
+NORM_SAMPLE_PIXELS = 1024**2
+
+
+def frame_scale(frame: np.ndarray) -> float:
+    """
+    The median of a frame, estimated from every nth row so only those rows of a memory mapped frame are read.
+    """
+    step = max(1, frame.size // NORM_SAMPLE_PIXELS)
+    return float(np.median(frame[::step]))
+
+
+def combine_frames(frames: list[np.ndarray], out: np.ndarray, normalise: bool) -> None:
+    """
+    Median combine frames into out, a block of rows at a time so only one block of the stack is ever in memory.
+    With normalise, each frame is scaled by its own (sampled) median first, as is done for flats.
+    """
+    norms = np.array([frame_scale(frame) if normalise else 1.0 for frame in frames], dtype=out.dtype)
+    norms[norms == 0] = 1.0
+    row_bytes = max(1, out[0].nbytes * len(frames))
+    step = max(1, CHUNK_BYTES // row_bytes)
+    for start in range(0, len(out), step):
+        stack = np.stack([frame[start : start + step] for frame in frames]).astype(out.dtype, copy=False)
+        stack /= norms.reshape((-1,) + (1,) * (stack.ndim - 1))
+        np.median(stack, axis=0, out=out[start : start + step])
+
+
+class MasterCalibrationCache:
+    """
+    Combined master calibrations, built once per set of input frames and shared by every exposure that uses them.
+
+    Masters are keyed on the type and the files combined (with their stat fingerprints), so a night's flats are
+    combined once and then served memory mapped to all its exposures. Building is guarded by a file lock, so
+    concurrent reductions wait for the first one to finish rather than building the same master twice.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.counts: Counter[str] = Counter()
+        self.lock = threading.Lock()
+
+    def key(self, file_type: FileType, files: list[Path]) -> str:
+        hasher = hashlib.blake2b(digest_size=20)
+        hasher.update(f"{file_type.value}:{COMBINE_VERSION}".encode())
+        for file in sorted(files):
+            hasher.update(f":{file}:{file_fingerprint(file)}".encode())
+        return hasher.hexdigest()
+
+    def count(self, outcome: str) -> None:
+        with self.lock:
+            self.counts[outcome] += 1
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.counts["hit"], "misses": self.counts["miss"]}
+
+    def get(self, file_type: FileType, files: list[Path]) -> ProductHandle:
+        """
+        The master calibration for the given files, combining them if no one has yet.
+        """
+        assert files, f"No {file_type.value} files given to build a master calibration from"
+        logger = get_logger()
+        key = self.key(file_type, files)
+        store = ProductStore(path=self.path / file_type.value / key)
+
+        handle = store.get(MASTER_NAME)
+        if handle is None:
+            store.path.mkdir(parents=True, exist_ok=True)
+            with open(store.path / f"{MASTER_NAME}.lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # Someone else may have built it while we waited on the lock
+                handle = store.get(MASTER_NAME)
+                if handle is None:
+                    self.count("miss")
+                    handle = self.build(file_type, files, store)
+                    logger.info(f"Built master {file_type.value} from {len(files)} files ({key}), {self.stats()}")
+                    return handle
+        self.count("hit")
+        logger.info(f"Using master {file_type.value} for {len(files)} files ({key}), {self.stats()}")
+        return handle
+
+    def build(self, file_type: FileType, files: list[Path], store: ProductStore) -> ProductHandle:
+        # Frames that have to be decoded are only needed while combining, so are kept in a temporary store
+        with tempfile.TemporaryDirectory(prefix="_frames.", dir=store.path) as frames_path:
+            frame_store = ProductStore(path=Path(frames_path))
+            frames = []
+            for i, file in enumerate(sorted(files)):
+                with FitsFile(file) as fits_file:
+                    frames.append(fits_file.product(1, frame_store, f"frame_{i}").load())
+            assert len({frame.shape for frame in frames}) == 1, f"{file_type.value} frames differ in shape: {files}"
+
+            out = store.allocate(MASTER_NAME, frames[0].shape, np.result_type(frames[0].dtype, np.float32))
+            combine_frames(frames, out, normalise=file_type == FileType.CONTINUUM)
+        return store.commit(
+            MASTER_NAME,
+            out,
+            type=file_type.value,
+            files=[str(file) for file in sorted(files)],
+            combine_version=COMBINE_VERSION,
+        )
+
+
+@cache
+def get_master_calibration_cache(path: Path) -> MasterCalibrationCache:
+    """
+    One cache per location and process, so hit/miss counts cover every exposure reduced in it.
+    """
+    return MasterCalibrationCache(path)
+
+
+@pipeline_task()
+def load_master_calibration(file_type: FileType, files: list[Path], resolver: Resolver) -> ProductHandle:
+    """
+    Load the master calibration combined from the given files, building it if this is the first exposure to need it.
+    """
+    return get_master_calibration_cache(resolver.master_calibration_path).get(file_type, files)
@@ -1,19 +1,29 @@
 import numpy as np
 
+from pipeline.common.cache import use_result_cache
 from pipeline.common.prefect_utils import pipeline_flow, pipeline_task
+from pipeline.common.products import ProductHandle, ProductStore
 from pipeline.config.reduce_channel_exposure import ChannelReduction
 from pipeline.resolver.resolver import Resolver
-from pipeline.tasks.common import load_header, load_image_data
+from pipeline.tasks.common import FitsFile
 
+# Bump this whenever the variance added changes, so results cached by earlier versions aren't used
+ADD_VARIANCE_VERSION = 1
 
-@pipeline_task()
-def add_variance(exposure: np.ndarray, variance: np.ndarray) -> np.ndarray:
+
+@pipeline_task(cache_results=True, cache_version=ADD_VARIANCE_VERSION)
+def add_variance(exposure: ProductHandle, variance: ProductHandle, store: ProductStore) -> ProductHandle:
+    exposure_data = exposure.load()
+    variance_data = variance.load()
+    # Write straight into the stored product rather than making a new array
+    result = store.allocate("variance", variance_data.shape, np.result_type(exposure_data, variance_data))
     # Congrats, Poisson noise variance is equal to number of electron samples.
-    return variance + exposure
+    np.add(variance_data, exposure_data, out=result)
+    return store.commit("variance", result, stage="add_variance")
 
 
 @pipeline_flow()
-def preprocess_exposure(config: ChannelReduction, resovler: Resolver):
+def preprocess_exposure(config: ChannelReduction, resovler: Resolver) -> tuple[ProductHandle, ProductHandle]:
     # TODO: binary offset model comes from somewhere and does something
     # TODO: We neber provide a bias file so this subtraction is useless
 
@@ -23,16 +33,20 @@ def preprocess_exposure(config: ChannelReduction, resovler: Resolver):
     # This is normally done by checking that POISNOIS, if it exists in the header, is not 1
     # TODO: In general I dislike all these magic header values and ideally would do something a bit more transparent
     # Anyway, if the noise isnt there, then we add poisson noise
-    header = load_header(science_file)
-    exposure = load_image_data(science_file, header=1)
-    variance = load_image_data(science_file, header=2)
+    # Stages pass handles onto memory mapped arrays in the product store rather than the arrays themselves
+    store = resovler.product_store(science_file)
+    with FitsFile(science_file) as fits_file:
+        header = fits_file.header()
+        exposure = fits_file.product(1, store, "raw_exposure")
+        variance = fits_file.product(2, store, "raw_variance")
 
     # TODO: Dont like magic strings, will pull this into a subconfig.
-    if header.get("POISNOIS") != 1:
-        variance = add_variance(exposure, variance)
+    with use_result_cache(config.use_cache):
+        if header.get("POISNOIS") != 1:
+            variance = add_variance(exposure, variance, store)
 
-    # TODO: figure out intermediate file situation. Ideally I dont want tons and tons of files with process
-    # TODO: information locked away in random file headers.
+    # Intermediate products live in the product store, with what made them kept in a JSON sidecar
+    # rather than locked away in random file headers.
     # if bias model: subtract bais model (what is the bias model passed in)
     # if there's a dark file: subtract it (I dont think we have darks)
     # if there's a dark map: subtract it (I dont think we have dark maps)
@@ -42,3 +56,5 @@ def preprocess_exposure(config: ChannelReduction, resovler: Resolver):
 
     # if we have a flat file: apply the flat
     # TODO: apparently custom flats can be an option and its specifically for R channel hot lines?
+
+    return exposure, variance
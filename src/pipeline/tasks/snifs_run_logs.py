@@ -1,27 +1,118 @@
-import re
-from datetime import datetime as dt
+from pathlib import Path
 
 import polars as pl
 
+from pipeline.common.files import JsonState, atomic_write
+from pipeline.common.log import get_logger
 from pipeline.common.prefect_utils import pipeline_task
 from pipeline.resolver.common import DATETIME_CONVERSION_EXPR, FileType
 from pipeline.resolver.resolver import Resolver
 
+CCD_ON_TIMES_NAME = "times.parquet"
+# Files starting with an underscore are not picked up by the filestore
+PARSE_STATE_NAME = "_parse_state.json"
+# Read the run log in blocks of about this many bytes, so years of logs are never all in memory at once
+RUN_LOG_CHUNK_BYTES = 64 * 1024**2
+
+# Only lines containing this are worth looking at, which is a tiny fraction of the log
+RUN_LOG_EVENT_MARKER = "SNIFS_on"
+# Times are written like `date`, e.g. "Tue Feb 25 09:00:00 UTC 2025", with the zone split out to be applied explicitly
+RUN_LOG_EVENT_PATTERN = (
+    r"SNIFS_on \d \d (?<channel>.) ==>\s*(?<time>\w+\s+\w+\s+\d+\s+[\d:]+)\s+(?<zone>[A-Za-z]+)\s+(?<year>\d{4})\s*$"
+)
+RUN_LOG_TIME_FORMAT = "%a %b %d %H:%M:%S %Y"
+# Hours ahead of UTC for the zones run log times are written in. Any other zone fails the parse rather than being
+# guessed at.
+RUN_LOG_TIME_ZONE_OFFSETS = {"UTC": 0, "GMT": 0, "HST": -10}
+CCD_ON_TIMES_SCHEMA = {"channel": pl.String, "time": pl.Datetime("ms", "UTC")}
+
+
+class RunLogParseState(JsonState):
+    source: str | None = None
+    # How far into the source we've parsed, always at the end of a complete line
+    offset: int = 0
+
+
+def parse_run_log_events(data: bytes) -> pl.DataFrame:
+    """
+    Parse the CCD on/off events out of complete lines of a SNIFS run log.
+    """
+    # Read as a single column of whole lines, which splits and decodes them across all cores
+    return (
+        pl.read_csv(
+            data,
+            has_header=False,
+            schema={"line": pl.String},
+            separator="\0",
+            quote_char=None,
+            encoding="utf8-lossy",
+            truncate_ragged_lines=True,
+            raise_if_empty=False,
+        )
+        .filter(pl.col("line").str.contains(RUN_LOG_EVENT_MARKER, literal=True))
+        .select(pl.col("line").str.extract_groups(RUN_LOG_EVENT_PATTERN).struct.unnest())
+        .drop_nulls()
+        .select(
+            pl.col("channel"),
+            pl.concat_str(pl.col("time").str.replace_all(r"\s+", " "), pl.col("year"), separator=" ")
+            .str.to_datetime(RUN_LOG_TIME_FORMAT, time_unit="ms", time_zone="UTC")
+            .sub(pl.duration(hours=pl.col("zone").replace_strict(RUN_LOG_TIME_ZONE_OFFSETS, return_dtype=pl.Int64)))
+            .alias("time"),
+        )
+        .with_columns(DATETIME_CONVERSION_EXPR)
+    )
+
+
+def read_run_log_events(path: Path, offset: int) -> tuple[list[pl.DataFrame], int]:
+    """
+    Stream through the run log from the given offset, a block at a time, parsing each block's complete lines.
+    Returns the events found and the offset of the end of the last complete line.
+    """
+    events = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        pending = b""
+        while chunk := f.read(RUN_LOG_CHUNK_BYTES):
+            pending += chunk
+            end = pending.rfind(b"\n") + 1
+            if end == 0:
+                continue
+            events.append(parse_run_log_events(pending[:end]))
+            offset += end
+            pending = pending[end:]
+    return events, offset
+
 
 @pipeline_task()
 def parse_snifs_run_logs(resolver: Resolver):
+    """
+    Parse the CCD on/off times out of the SNIFS run log into the CCD_ON_TIMES table.
+    Only what has been appended to the log since it was last parsed is read, with new events appended to the table.
+    """
+    logger = get_logger()
     raw_logs_path = resolver.get_match_path(FileType.RAW_LOGS)
-    regex = re.compile(r"SNIFS_on \d \d (.) ==>(.*)\s+$")
-    lines = raw_logs_path.read_text(encoding="UTF-8", errors="replace").splitlines()
-    lines = [line for line in lines if "SNIFS_on" in line]
-    results = []
-    for line in lines:
-        if match := regex.search(line):
-            channel, time_str = match.group(1), match.group(2)
-            results.append({"channel": channel, "time": dt.strptime(time_str, "%a %b %d %H:%M:%S %Z %Y")})
-
-    output_path = resolver.processed_data_path / f"type={FileType.CCD_ON_TIMES.value}" / "times.parquet"
+    output_path = resolver.processed_data_path / f"type={FileType.CCD_ON_TIMES.value}" / CCD_ON_TIMES_NAME
+    state_path = output_path.parent / PARSE_STATE_NAME
     output_path.parent.mkdir(parents=True, exist_ok=True)
-    df = pl.DataFrame(results).sort("time").with_columns(DATETIME_CONVERSION_EXPR)
-    df.write_parquet(output_path, compression="gzip")
-    resolver.ensure_file_exists(output_path)
+
+    state = RunLogParseState.load(state_path)
+    if state.source != str(raw_logs_path) or not output_path.exists() or raw_logs_path.stat().st_size < state.offset:
+        # A different or replaced log, or the table has gone, so parse the whole log again
+        logger.info(f"Parsing SNIFS run log {raw_logs_path} from the start")
+        state = RunLogParseState(source=str(raw_logs_path))
+        existing = None
+    else:
+        existing = pl.read_parquet(output_path)
+
+    events, offset = read_run_log_events(raw_logs_path, state.offset)
+    logger.info(f"Read {offset - state.offset} new bytes of SNIFS run log {raw_logs_path}")
+    new_events = pl.concat(events) if events else pl.DataFrame(schema=CCD_ON_TIMES_SCHEMA)
+
+    if existing is None or len(new_events):
+        df = new_events if existing is None else pl.concat([existing, new_events])
+        with atomic_write(output_path) as staging:
+            df.sort("time", maintain_order=True).write_parquet(staging)
+        logger.info(f"Added {len(new_events)} CCD on/off events, {len(df)} in total")
+        resolver.ensure_file_exists(output_path)
+
+    RunLogParseState(source=state.source, offset=offset).save(state_path)
@@ -0,0 +1,102 @@
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pipeline.common.prefect_utils import plain_calls
+from pipeline.config.global_settings import settings
+from pipeline.resolver.common import extract_file_record, header_keywords, read_header_with_astropy
+from pipeline.resolver.fits_header import read_primary_header
+from pipeline.tasks import build_filestore as build_filestore_module
+from pipeline.tasks.build_filestore import build_filestore, extract_all_file_records
+
+
+def write_exposure(path: Path, obstype: str, channel: str, exposure_seconds: float) -> None:
+    header = fits.Header()
+    header["OBSTYPE"] = obstype
+    header["RUNID"] = path.parent.name.removeprefix("run_id=")
+    header["CHANNEL"] = channel
+    header["OBJECT"] = "O'Brien's star"
+    header["DATE-OBS"] = "2025-02-25T09:00:00"
+    header["EXPTIME"] = exposure_seconds
+    header["ROTANGLE"] = -12.5
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fits.PrimaryHDU(np.zeros((4, 4), dtype=np.int16), header=header).writeto(path)
+
+
+@pytest.fixture
+def data_path(tmp_path: Path) -> Path:
+    for i, (obstype, channel) in enumerate([("OBJECT", "B"), ("OBJECT", "R"), ("ARC", "B"), ("FLAT", "R")]):
+        write_exposure(tmp_path / "runs" / f"run_id=25_00{i % 2}" / f"exp{i}.fits", obstype, channel, 10.0 * i)
+    weather = tmp_path / "misc" / "type=WEATHER" / "station=CFHT" / "year=2025" / "month=02" / "weather.parquet"
+    weather.parent.mkdir(parents=True)
+    weather.write_bytes(b"not read")
+    return tmp_path
+
+
+def test_parallel_extraction_matches_serial(data_path: Path):
+    files = sorted(file for file in data_path.rglob("*") if file.is_file())
+    relative_paths = [file.relative_to(data_path) for file in files]
+
+    serial = extract_all_file_records(files, relative_paths, max_workers=1)
+    parallel = extract_all_file_records(files, relative_paths, max_workers=2)
+
+    # Only the time added differs between the two runs
+    assert [record.pop("time_added") and record for record in serial] == [
+        record.pop("time_added") and record for record in parallel
+    ]
+    assert [record["file_path"] for record in parallel] == [str(path) for path in relative_paths]
+    assert {record.get("type") for record in parallel} == {"OBJECT", "ARC", "FLAT", "WEATHER"}
+
+
+def test_fast_header_reader_matches_astropy(data_path: Path):
+    keywords = header_keywords().values()
+    for file in data_path.rglob("*.fits"):
+        assert read_primary_header(file, keywords) == read_header_with_astropy(file, keywords)
+
+
+@pytest.fixture
+def extracted(data_path: Path, monkeypatch: pytest.MonkeyPatch) -> Counter[str]:
+    """
+    Counts of the files extracted by build_filestore, by path relative to the data path.
+    """
+    monkeypatch.setattr(settings, "data_path", data_path)
+    monkeypatch.setattr(settings, "output_path", data_path / "output")
+    monkeypatch.setattr(settings, "partition_file_store", False)
+    counts: Counter[str] = Counter()
+
+    def counting_extract_file_record(path: Path, relative_path: Path):
+        counts[str(relative_path)] += 1
+        return extract_file_record(path, relative_path)
+
+    monkeypatch.setattr(build_filestore_module, "extract_file_record", counting_extract_file_record)
+    return counts
+
+
+def test_each_file_is_extracted_once(data_path: Path, extracted: Counter[str]):
+    with plain_calls():
+        resolver = build_filestore(refresh=True, max_workers=1)
+
+    assert set(extracted.values()) == {1}
+    assert sorted(extracted) == sorted(resolver.file_store["file_path"])
+    assert len(extracted) == 5
+
+
+def test_refresh_extracts_only_changed_files(data_path: Path, extracted: Counter[str]):
+    with plain_calls():
+        build_filestore(max_workers=1)
+        extracted.clear()
+        build_filestore(max_workers=1)
+        assert not extracted
+
+        changed = data_path / "runs" / "run_id=25_001" / "exp1.fits"
+        changed.unlink()
+        write_exposure(changed, "OBJECT", "R", 100.0)
+        resolver = build_filestore(max_workers=1)
+
+    assert extracted == Counter({"runs/run_id=25_001/exp1.fits": 1})
+    exposure = resolver.file_store_index.get_row("runs/run_id=25_001/exp1.fits")
+    assert exposure is not None
+    assert exposure["exposure_seconds"] == 100.0
@@ -0,0 +1,90 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from pipeline.common.cache import cache_array_result, compute_cache_key, get_result_cache
+from pipeline.common.products import ProductHandle, ProductStore
+from pipeline.config.global_settings import settings
+
+
+@pytest.fixture(autouse=True)
+def cache_path(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.setattr(settings, "cache_path", tmp_path / "cache")
+    return tmp_path / "cache"
+
+
+def test_cached_task_hits_until_its_input_changes(tmp_path: Path):
+    calls = []
+
+    @cache_array_result
+    def double(exposure: ProductHandle) -> np.ndarray:
+        calls.append(exposure)
+        return exposure.load() * 2
+
+    store = ProductStore(path=tmp_path / "products")
+    exposure = store.put("exposure", np.arange(6, dtype=np.float32).reshape(2, 3))
+
+    first = double(exposure)
+    second = double(exposure)
+    assert len(calls) == 1
+    np.testing.assert_array_equal(first, second)
+
+    # Rewriting the product changes its fingerprint, so the cached result no longer applies
+    exposure = store.put("exposure", np.ones((2, 3), dtype=np.float32))
+    np.testing.assert_array_equal(double(exposure), np.full((2, 3), 2, dtype=np.float32))
+    assert len(calls) == 2
+
+
+def test_cached_product_handle_is_a_miss_once_overwritten(tmp_path: Path):
+    store = ProductStore(path=tmp_path / "products")
+    cache = get_result_cache()
+    handle = store.put("variance", np.zeros(4))
+    cache.put("key", handle)
+    assert cache.get("key") == handle
+
+    store.put("variance", np.ones(4))
+    assert cache.get("key") is None
+    assert cache.get("missing") is None
+
+
+def test_memmapped_arrays_are_keyed_on_their_file(tmp_path: Path):
+    def func(data: np.ndarray) -> None:
+        pass
+
+    path = tmp_path / "data.npy"
+    np.save(path, np.zeros(4))
+    key = compute_cache_key(func, (np.load(path, mmap_mode="r"),), {})
+    assert compute_cache_key(func, (np.load(path, mmap_mode="r"),), {}) == key
+
+    np.save(path, np.zeros(5))
+    assert compute_cache_key(func, (np.load(path, mmap_mode="r"),), {}) != key
+
+
+def test_version_is_part_of_the_key():
+    def func(factor: float) -> None:
+        pass
+
+    key = compute_cache_key(func, (2.0,), {})
+    assert compute_cache_key(func, (2.0,), {}, version=0) == key
+    assert compute_cache_key(func, (2.0,), {}, version=1) != key
+
+
+def test_unsupported_inputs_are_rejected():
+    def func(data: np.ndarray) -> None:
+        pass
+
+    with pytest.raises(TypeError):
+        compute_cache_key(func, (np.zeros(4),), {})
+
+
+def test_eviction_keeps_the_cache_within_budget(monkeypatch: pytest.MonkeyPatch):
+    # Room for a few entries, each an array plus its .npy header
+    monkeypatch.setattr(settings, "cache_max_bytes", 3 * (np.zeros(100).nbytes + 128))
+    cache = get_result_cache()
+    for i in range(10):
+        cache.put(f"{i:02d}", np.zeros(100))
+
+    sizes = [path.stat().st_size for path in cache.path.glob("*/*.npy")]
+    assert sum(sizes) <= cache.max_bytes
+    assert cache.get("09") is not None
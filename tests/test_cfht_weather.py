@@ -0,0 +1,148 @@
+from datetime import datetime as dt
+from datetime import timedelta as td
+from datetime import timezone as tz
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+import polars as pl
+import pytest
+
+from pipeline.common.files import file_fingerprint
+from pipeline.common.prefect_utils import plain_calls
+from pipeline.config.global_settings import settings
+from pipeline.tasks import cfht_weather
+from pipeline.tasks.cfht_weather import (
+    WEATHER_FETCH_STATE_NAME,
+    WEATHER_STORE_PATH,
+    WeatherFetchState,
+    WeatherManifest,
+    WeatherStore,
+)
+
+HAWAII = ZoneInfo("Pacific/Honolulu")
+
+
+def weather_line(time: dt, temperature: float) -> str:
+    # CFHT's archive is in Hawaii time
+    time = time.astimezone(HAWAII)
+    return f"{time:%Y %m %d %H %M} 10 180 {temperature} 20 615.5\n"
+
+
+@pytest.fixture
+def source(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """
+    A local weather archive for the current (Hawaii) year, that update_cfht_weather reads from.
+    """
+    monkeypatch.setattr(settings, "data_path", tmp_path / "data")
+    monkeypatch.setattr(settings, "output_path", tmp_path / "output")
+    monkeypatch.setattr(settings, "cfht_weather_source", str(tmp_path / "cfht-wx.{year}.dat"))
+    return tmp_path / f"cfht-wx.{dt.now(tz=HAWAII).year}.dat"
+
+
+def test_only_new_weather_is_fetched(source: Path, monkeypatch: pytest.MonkeyPatch):
+    parsed: list[bytes] = []
+    parse = cfht_weather.parse_cfht_weather
+    monkeypatch.setattr(cfht_weather, "parse_cfht_weather", lambda data: parsed.append(data) or parse(data))
+    # Whole minutes, as the archive has no seconds
+    now = dt.now(tz=tz.utc).replace(second=0, microsecond=0)
+    first = "".join(weather_line(now - td(hours=hours), hours) for hours in (3, 2, 1))
+    source.write_text(first)
+
+    with plain_calls():
+        cfht_weather.update_cfht_weather()
+        # A partly written line is left for the next fetch
+        newer = weather_line(now - td(minutes=30), 0.5)
+        with source.open("a") as f:
+            f.write(newer + "2025 01")
+        cfht_weather.update_cfht_weather()
+
+    assert parsed == [first.encode(), newer.encode()]
+    store = WeatherStore(settings.data_path / WEATHER_STORE_PATH)
+    assert store.scan().collect()["temperature"].to_list() == [3.0, 2.0, 1.0, 0.5]
+    state = WeatherFetchState.load(store.path / WEATHER_FETCH_STATE_NAME)
+    assert state.sources[str(source)].offset == len(first) + len(newer)
+
+
+def test_freshness_comes_from_the_manifest(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    store = WeatherStore(tmp_path / "weather")
+    assert cfht_weather.should_fetch_data(store)
+    now = dt.now(tz=tz.utc).replace(second=0, microsecond=0)
+    store.append(cfht_weather.parse_cfht_weather(weather_line(now - td(hours=1), 1.5).encode()))
+    manifest = WeatherManifest.model_validate_json(store.manifest_path.read_text())
+    assert manifest.latest_time == now - td(hours=1)
+
+    # A current manifest is trusted without the weather being read
+    def fail_to_scan(*args, **kwargs):
+        raise AssertionError("The weather was read")
+
+    monkeypatch.setattr(cfht_weather.pl, "scan_parquet", fail_to_scan)
+    assert store.latest_time() == now - td(hours=1)
+    assert cfht_weather.should_fetch_data(store)
+    monkeypatch.undo()
+
+    # Once the latest partition changes behind the manifest's back, it is ignored and rebuilt
+    latest_partition = store.path / manifest.latest_partition
+    latest = pl.read_parquet(latest_partition).with_columns(pl.col("time") + td(minutes=58))
+    latest.write_parquet(latest_partition)
+    assert store.latest_time() == now - td(minutes=2)
+    assert not cfht_weather.should_fetch_data(store)
+    rebuilt = WeatherManifest.model_validate_json(store.manifest_path.read_text())
+    assert rebuilt.fingerprint == file_fingerprint(latest_partition)
+
+
+def test_weather_is_attached_as_of_each_observation(tmp_path: Path):
+    store = WeatherStore(tmp_path / "weather")
+    start = dt(2025, 1, 31, 23, 50, tzinfo=tz.utc)
+    # Points ten minutes apart either side of a month (and so partition) boundary, with temperatures 0, 1 and 2
+    store.append(
+        cfht_weather.parse_cfht_weather("".join(weather_line(start + td(minutes=10 * i), i) for i in range(3)).encode())
+    )
+    assert len(store.partitions()) == 2
+
+    times = [
+        start + td(minutes=15),
+        start + td(minutes=5),
+        None,
+        start + td(minutes=45),
+    ]
+    weather = store.lookup(times)
+    # Rows keep their order, the prior point is used, and nothing is matched further back than the tolerance
+    assert weather["weather_time"].to_list() == [
+        start + td(minutes=10),
+        start,
+        None,
+        None,
+    ]
+    assert weather["temperature"].to_list() == [1.0, 0.0, None, None]
+
+    interpolated = store.lookup(times, interpolate=True)
+    assert interpolated["temperature"].to_list() == [1.5, 0.5, None, None]
+    # Wind direction is circular, so is never interpolated
+    assert interpolated["wind_direction"].to_list() == [180, 180, None, None]
+
+
+def test_decimation_keeps_each_buckets_extremes():
+    times = [dt(2025, 2, 1, tzinfo=tz.utc) + td(minutes=i) for i in range(100)]
+    values = [float(i % 10) for i in range(100)]
+    df = pl.DataFrame({"time": times, "temperature": values})
+
+    decimated = cfht_weather.decimate_min_max(df, "temperature", num_buckets=10)
+    assert len(decimated) == 20
+    assert decimated["temperature"].to_list() == [0.0, 9.0] * 10
+    # Short series are already small enough to plot as they are
+    assert cfht_weather.decimate_min_max(df.head(20), "temperature", num_buckets=10).equals(df.head(20))
+
+
+def test_unchanged_weather_is_not_plotted_again(tmp_path: Path):
+    now = dt.now(tz=tz.utc).replace(second=0, microsecond=0)
+    data = "".join(weather_line(now - td(hours=hours), hours) for hours in range(48, 0, -1))
+    df = cfht_weather.parse_cfht_weather(data.encode())
+    output_path = tmp_path / "cfht_weather.png"
+
+    cfht_weather.plot_weather_data(df, tmp_path, dpi=20)
+    plotted = output_path.stat().st_mtime_ns
+    cfht_weather.plot_weather_data(df, tmp_path, dpi=20)
+    assert output_path.stat().st_mtime_ns == plotted
+
+    cfht_weather.plot_weather_data(df.with_columns(pl.col("temperature") + 1), tmp_path, dpi=20)
+    assert output_path.stat().st_mtime_ns != plotted
@@ -0,0 +1,45 @@
+import mmap
+from pathlib import Path
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pipeline.tasks.common import FitsFile
+
+
+def is_memory_mapped(array: np.ndarray) -> bool:
+    base = array.base
+    while isinstance(base, np.ndarray):
+        base = base.base
+    return isinstance(base, mmap.mmap)
+
+
+@pytest.fixture
+def exposure(tmp_path: Path) -> Path:
+    path = tmp_path / "exposure.fits"
+    primary = fits.PrimaryHDU()
+    primary.header["OBSTYPE"] = "OBJECT"
+    data = np.arange(12, dtype=np.float32).reshape(3, 4)
+    fits.HDUList([primary, fits.ImageHDU(data), fits.ImageHDU(data * 2)]).writeto(path)
+    return path
+
+
+def test_data_is_a_read_only_view_onto_the_memory_map(exposure: Path):
+    with FitsFile(exposure) as fits_file:
+        header = fits_file.header()
+        exposure_data = fits_file.data(1)
+        variance_data = fits_file.data(2)
+
+    assert header["OBSTYPE"] == "OBJECT"
+    assert is_memory_mapped(exposure_data)
+    assert not exposure_data.flags.writeable
+    with pytest.raises(ValueError):
+        exposure_data[0, 0] = 1
+    # Views stay usable once the file is closed
+    np.testing.assert_array_equal(variance_data, np.arange(12, dtype=np.float32).reshape(3, 4) * 2)
+
+
+def test_missing_hdus_are_reported(exposure: Path):
+    with FitsFile(exposure) as fits_file, pytest.raises(AssertionError, match="does not have HDU 3"):
+        fits_file.data(3)
@@ -0,0 +1,57 @@
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+from pipeline.common.instrumentation import instrumented
+from pipeline.config.global_settings import settings
+
+
+@pytest.fixture
+def metrics_path(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.setattr(settings, "instrument", True)
+    monkeypatch.setattr(settings, "metrics_path", tmp_path / "metrics")
+    return tmp_path / "metrics"
+
+
+def test_runs_are_exported_as_metrics_and_nested_spans(metrics_path: Path):
+    def read_file(fail: bool) -> bytes:
+        assert not fail, "Bad file"
+        return bytes(1024)
+
+    load = instrumented(read_file, "task", "load")
+
+    def reduce() -> None:
+        load(False)
+        with pytest.raises(AssertionError):
+            load(True)
+
+    instrumented(reduce, "flow", "reduce")()
+
+    textfile = (metrics_path / f"pipeline_{os.getpid()}.prom").read_text()
+    pid = os.getpid()
+    assert f'pipeline_run_invocations_total{{kind="task",name="load",status="ok",pid="{pid}"}} 1' in textfile
+    assert f'pipeline_run_invocations_total{{kind="task",name="load",status="error",pid="{pid}"}} 1' in textfile
+    assert f'pipeline_run_invocations_total{{kind="flow",name="reduce",status="ok",pid="{pid}"}} 1' in textfile
+    assert "# TYPE pipeline_run_max_rss_bytes gauge" in textfile
+
+    spans = [
+        json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"][0]
+        for line in (metrics_path / "spans.otlp.jsonl").read_text().splitlines()
+    ]
+    # Spans are written as runs finish, so the flow comes last
+    assert [(span["name"], span["status"]["code"]) for span in spans] == [("load", 1), ("load", 2), ("reduce", 1)]
+    flow = spans[-1]
+    assert flow["parentSpanId"] == ""
+    assert len(flow["traceId"]) == 32
+    assert len(flow["spanId"]) == 16
+    for task in spans[:2]:
+        assert task["traceId"] == flow["traceId"]
+        assert task["parentSpanId"] == flow["spanId"]
+
+
+def test_nothing_is_recorded_unless_turned_on(metrics_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(settings, "instrument", False)
+    assert instrumented(lambda: 1, "task", "noop")() == 1
+    assert not metrics_path.exists()
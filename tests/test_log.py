@@ -0,0 +1,94 @@
+import contextvars
+import logging
+from collections.abc import Iterator
+from functools import partial
+
+import pytest
+from loguru import logger
+from opentelemetry import trace
+from opentelemetry.trace import NonRecordingSpan, SpanContext, TraceFlags
+
+from pipeline.common import log
+from pipeline.common.log import RunLogger, get_logger, patch_span, sample_record
+
+
+@pytest.fixture
+def records() -> Iterator[list[dict]]:
+    """
+    The loguru records logged during a test.
+    """
+    captured: list[dict] = []
+    sink_id = logger.add(lambda message: captured.append(message.record), level="DEBUG")
+    yield captured
+    logger.remove(sink_id)
+
+
+def test_span_ids_are_written_at_their_full_width(records: list[dict]):
+    span_context = SpanContext(trace_id=0xABC, span_id=0xDEF, is_remote=False, trace_flags=TraceFlags(1))
+    with trace.use_span(NonRecordingSpan(span_context)):
+        logger.patch(partial(patch_span, "test", False)).info("in a span")
+
+    extra = records[0]["extra"]
+    assert extra["trace_id"] == f"{0xABC:032x}"
+    assert extra["span_id"] == f"{0xDEF:016x}"
+
+
+def test_sampling_only_applies_to_the_given_levels():
+    kept: list[str] = []
+    sample = partial(sample_record, {"DEBUG": 0.0})
+    sink_id = logger.add(lambda message: kept.append(message.record["message"]), level="DEBUG", filter=sample)
+    try:
+        logger.debug("dropped")
+        logger.info("kept")
+    finally:
+        logger.remove(sink_id)
+    assert kept == ["kept"]
+
+
+def test_run_logger_sends_debug_to_our_sink(records: list[dict], caplog: pytest.LogCaptureFixture):
+    run_logger = RunLogger(logging.LoggerAdapter(logging.getLogger("prefect.test_run"), {"task_run_id": "abc"}))
+
+    with caplog.at_level(logging.INFO, logger="prefect.test_run"):
+        run_logger.debug("Loaded %(count)d keys from %(file)s", {"count": 3, "file": "a.fits"})
+        try:
+            raise ValueError("bad header")
+        except ValueError:
+            run_logger.debug("Failed to read %s", "b.fits", exc_info=True)
+        run_logger.info("Reduced %s", "a.fits")
+
+    assert [record["message"] for record in records] == ["Loaded 3 keys from a.fits", "Failed to read b.fits"]
+    assert all(record["extra"]["task_run_id"] == "abc" for record in records)
+    # The caller is whoever called debug, not the adapter
+    assert {record["function"] for record in records} == {"test_run_logger_sends_debug_to_our_sink"}
+    assert records[1]["exception"].type is ValueError
+    # Anything above debug still goes through prefect's logger
+    assert [record.getMessage() for record in caplog.records] == ["Reduced a.fits"]
+    assert caplog.records[0].funcName == "test_run_logger_sends_debug_to_our_sink"
+
+
+def test_getting_a_logger_leaves_sinks_alone(records: list[dict], monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(log, "_logging_configured", False)
+    get_logger().info("kept")
+    assert [record["message"] for record in records] == ["kept"]
+    assert not log._logging_configured
+
+
+def test_run_logger_is_made_once_per_run_context(monkeypatch: pytest.MonkeyPatch):
+    task_run, flow_run = object(), object()
+    contexts = [(task_run, flow_run)]
+    made = []
+    monkeypatch.setattr(log, "current_run_contexts", lambda: contexts[-1])
+    monkeypatch.setattr(log, "make_run_logger", lambda: made.append(object()) or made[-1])
+
+    def get_loggers() -> list:
+        first = get_logger()
+        assert get_logger() is first
+        contexts.append((object(), flow_run))
+        second = get_logger()
+        contexts.append((None, None))
+        return [first, second, get_logger()]
+
+    # Run in a fresh context, so nothing cached by other tests is picked up
+    first, second, outside = contextvars.copy_context().run(get_loggers)
+    assert made == [first, second]
+    assert outside is logger
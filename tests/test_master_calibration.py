@@ -0,0 +1,54 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pipeline.resolver.common import FileType
+from pipeline.tasks.master_calibration import MasterCalibrationCache
+
+
+def write_frame(path: Path, data: np.ndarray, scaled: bool = False) -> Path:
+    hdu = fits.ImageHDU(data)
+    if scaled:
+        # Scaled data can't be memory mapped, so has to be decoded before combining
+        hdu.scale("int16", bzero=1000)
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(path, overwrite=True)
+    return path
+
+
+@pytest.fixture
+def frames(tmp_path: Path) -> list[Path]:
+    return [
+        write_frame(tmp_path / "a.fits", np.full((8, 4), 1.0, dtype=np.float32)),
+        write_frame(tmp_path / "b.fits", np.full((8, 4), 2.0, dtype=np.float32)),
+        write_frame(tmp_path / "c.fits", np.full((8, 4), 6.0), scaled=True),
+    ]
+
+
+@pytest.mark.parametrize("file_type", [FileType.ARC, FileType.CONTINUUM])
+def test_master_is_built_once_then_shared(tmp_path: Path, frames: list[Path], file_type: FileType):
+    cache = MasterCalibrationCache(tmp_path / "masters")
+
+    master = cache.get(file_type, frames)
+    assert cache.stats() == {"hits": 0, "misses": 1}
+    again = cache.get(file_type, list(reversed(frames)))
+    assert cache.stats() == {"hits": 1, "misses": 1}
+    assert again == master
+
+    # Flats are normalised by their own median before combining, arcs are combined as they are
+    expected = 1.0 if file_type == FileType.CONTINUUM else 2.0
+    np.testing.assert_allclose(master.load(), np.full((8, 4), expected))
+    # Decoded frames only live as long as the build
+    assert not list((tmp_path / "masters").rglob("_frames.*"))
+
+
+def test_changed_frame_builds_a_new_master(tmp_path: Path, frames: list[Path]):
+    cache = MasterCalibrationCache(tmp_path / "masters")
+    master = cache.get(FileType.ARC, frames)
+
+    write_frame(frames[0], np.full((8, 4), 10.0, dtype=np.float32))
+    rebuilt = cache.get(FileType.ARC, frames)
+    assert cache.stats() == {"hits": 0, "misses": 2}
+    assert rebuilt.path != master.path
+    np.testing.assert_allclose(rebuilt.load(), np.full((8, 4), 6.0))
@@ -0,0 +1,121 @@
+from datetime import datetime as dt
+from datetime import timezone as tz
+from pathlib import Path
+
+import polars as pl
+import pytest
+
+from pipeline.resolver import FileStoreDataFrame, FileStoreIndex, FileStoreRecords, Resolver
+from pipeline.resolver.common import FileType, file_records_to_frame
+from pipeline.resolver.registry import file_match_registry
+
+TIME_ADDED = dt(2025, 3, 1, tzinfo=tz.utc)
+
+
+def science(name: str, run_id: str | None, channel: str | None, observed: dt | None) -> dict:
+    return {
+        "file_path": f"runs/run_id={run_id}/{name}.fits",
+        "type": "OBJECT",
+        "run_id": run_id,
+        "channel": channel,
+        "object": "star",
+        "time_observation": observed,
+    }
+
+
+def calibration(name: str, file_type: str, run_id: str, channel: str) -> dict:
+    return {
+        "file_path": f"runs/run_id={run_id}/{name}.fits",
+        "type": file_type,
+        "run_id": run_id,
+        "channel": channel,
+        "object": "star",
+    }
+
+
+def weather(station: str, year: int, month: int) -> dict:
+    return {
+        "file_path": f"misc/type=WEATHER/station={station}/year={year}/month={month:02d}/weather.parquet",
+        "type": "WEATHER",
+        "station": station,
+        "year": f"{year}",
+        "month": f"{month:02d}",
+    }
+
+
+SCIENCE_FILES = [
+    science("covered", "25_001", "B", dt(2025, 2, 1, 0, 5, tzinfo=tz.utc)),
+    science("new_year", "25_001", "R", dt(2025, 1, 3, tzinfo=tz.utc)),
+    science("uncovered", "25_002", "B", dt(2025, 6, 10, tzinfo=tz.utc)),
+    science("no_time", "25_002", "R", None),
+    science("no_run", None, None, dt(2025, 2, 20, tzinfo=tz.utc)),
+]
+
+
+def make_file_store() -> FileStoreDataFrame:
+    records = [
+        *SCIENCE_FILES,
+        calibration("arc_b", "ARC", "25_001", "B"),
+        calibration("arc_r", "ARC", "25_001", "R"),
+        calibration("flat_b_1", "FLAT", "25_002", "B"),
+        calibration("flat_b_2", "FLAT", "25_002", "B"),
+        weather("CFHT", 2024, 12),
+        weather("CFHT", 2025, 1),
+        weather("CFHT", 2025, 2),
+        weather("UH88", 2025, 2),
+    ]
+    for record in records:
+        record |= {"file_name": Path(record["file_path"]).name, "time_added": TIME_ADDED}
+    return file_records_to_frame(records).pipe(FileStoreDataFrame)
+
+
+@pytest.fixture(params=["index", "partitioned"])
+def file_store(request: pytest.FixtureRequest, tmp_path: Path):
+    df = make_file_store()
+    if request.param == "index":
+        return FileStoreIndex(df)
+    resolver = Resolver(
+        file_store_path=tmp_path / "filestore", data_path=tmp_path, output_path=tmp_path, partition_file_store=True
+    )
+    resolver.save_filestore(df)
+    return resolver.file_store_index
+
+
+@pytest.mark.parametrize("file_type", [FileType.ARC, FileType.CONTINUUM, FileType.WEATHER])
+def test_batch_matches_single(file_store, file_type: FileType):
+    primaries = file_store.get_rows([record["file_path"] for record in SCIENCE_FILES])
+    batch = file_match_registry.get_batch_matches(file_type, primaries, file_store)
+
+    expected = [
+        (primary.file_path, file_path)
+        for primary in FileStoreRecords(primaries)
+        for file_path in file_match_registry.get_matches(file_type, primary, file_store).file_paths
+    ]
+    assert list(batch.iter_rows()) == expected
+
+
+def test_weather_matches_covering_and_previous_partitions(file_store):
+    primaries = file_store.get_rows([record["file_path"] for record in SCIENCE_FILES])
+    matches = (
+        file_match_registry.get_batch_matches(FileType.WEATHER, primaries, file_store)
+        .group_by("primary_path", maintain_order=True)
+        .agg(pl.col("file_path").str.extract(r"station=(\w+)/year=(\d+)/month=(\d+)", 0))
+    )
+    matches = dict(matches.iter_rows())
+    all_weather = [
+        "station=CFHT/year=2024/month=12",
+        "station=CFHT/year=2025/month=01",
+        "station=CFHT/year=2025/month=02",
+        "station=UH88/year=2025/month=02",
+    ]
+    assert matches["runs/run_id=25_001/covered.fits"] == [
+        "station=CFHT/year=2025/month=02",
+        "station=UH88/year=2025/month=02",
+        "station=CFHT/year=2025/month=01",
+    ]
+    assert matches["runs/run_id=25_001/new_year.fits"] == [
+        "station=CFHT/year=2025/month=01",
+        "station=CFHT/year=2024/month=12",
+    ]
+    assert sorted(matches["runs/run_id=25_002/uncovered.fits"]) == all_weather
+    assert sorted(matches["runs/run_id=25_002/no_time.fits"]) == all_weather
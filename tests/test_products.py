@@ -0,0 +1,71 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pipeline.common.products import ProductStore
+from pipeline.tasks.common import FitsFile
+
+
+@pytest.fixture
+def store(tmp_path: Path) -> ProductStore:
+    return ProductStore(path=tmp_path / "products")
+
+
+def test_products_round_trip_memory_mapped(store: ProductStore):
+    array = np.arange(20, dtype=np.float32).reshape(4, 5)
+    handle = store.put("exposure", array, stage="test")
+
+    assert store.get("exposure") == handle
+    assert handle.metadata == {"stage": "test"}
+    loaded = handle.load()
+    assert isinstance(loaded, np.memmap)
+    assert not loaded.flags.writeable
+    np.testing.assert_array_equal(loaded, array)
+    # Nothing is left in the store but the product and its sidecar
+    assert sorted(path.name for path in store.path.iterdir()) == ["exposure.json", "exposure.npy"]
+
+
+def test_allocated_products_are_only_visible_once_committed(store: ProductStore):
+    out = store.allocate("variance", (3, 3), np.float64)
+    out[:] = 2.0
+    assert store.get("variance") is None
+
+    handle = store.commit("variance", out)
+    np.testing.assert_array_equal(handle.load(), np.full((3, 3), 2.0))
+
+
+def test_overwritten_products_are_stale(store: ProductStore):
+    old = store.put("exposure", np.zeros(4))
+    new = store.put("exposure", np.ones(5))
+
+    assert not old.is_current()
+    with pytest.raises(AssertionError, match="has changed or been removed"):
+        old.load()
+    assert store.get("exposure") == new
+
+    new.path.unlink()
+    assert store.get("exposure") is None
+    assert store.get("missing") is None
+
+
+def test_fits_data_is_referenced_in_place_unless_it_needs_decoding(tmp_path: Path, store: ProductStore):
+    data = np.arange(12, dtype=np.float32).reshape(3, 4)
+    scaled = fits.ImageHDU(data.copy())
+    scaled.scale("int16", bzero=1000)
+    path = tmp_path / "exposure.fits"
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data), scaled]).writeto(path)
+
+    with FitsFile(path) as fits_file:
+        in_place = fits_file.product(1, store, "raw_exposure")
+        decoded = fits_file.product(2, store, "raw_variance")
+        reused = fits_file.product(2, store, "raw_variance")
+
+    assert in_place.path == path
+    assert store.get("raw_exposure") is None
+    np.testing.assert_array_equal(in_place.load(), data)
+    assert decoded.path == store.array_path("raw_variance")
+    np.testing.assert_allclose(decoded.load(), data)
+    # An unchanged FITS file reuses the copy already decoded from it
+    assert reused == decoded
@@ -0,0 +1,52 @@
+import pstats
+import time
+from pathlib import Path
+
+import pytest
+
+from pipeline.common.profiling import profiled
+from pipeline.config.global_settings import Settings, settings
+
+
+@pytest.fixture
+def profile_path(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.setattr(settings, "profile", True)
+    monkeypatch.setattr(settings, "profile_path", tmp_path / "profiles")
+    monkeypatch.setattr(settings, "profile_interval_seconds", 0.001)
+    return tmp_path / "profiles"
+
+
+def busy_wait(seconds: float) -> None:
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_profiled_runs_write_pstats_and_collapsed_stacks(profile_path: Path):
+    outer = profiled(lambda: inner(), "outer")
+    inner = profiled(lambda: busy_wait(0.05), "inner")
+    outer()
+
+    # The nested run is left to the outer run's profile
+    (pstats_path,) = profile_path.glob("*.pstats")
+    (collapsed_path,) = profile_path.glob("*.collapsed")
+    assert pstats_path.name.startswith("outer-")
+    assert any("busy_wait" in func for _, _, func in pstats.Stats(str(pstats_path)).stats)
+
+    stacks = [line.rpartition(" ") for line in collapsed_path.read_text().splitlines()]
+    assert stacks
+    assert all(count.isdigit() for _, _, count in stacks)
+    assert any("busy_wait" in stack.split(";")[-1] for stack, _, _ in stacks)
+
+
+def test_only_the_named_tasks_are_profiled(profile_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(settings, "profile_tasks", ["wanted"])
+    profiled(lambda: None, "unwanted")()
+    assert not profile_path.exists()
+    profiled(lambda: None, "wanted")()
+    assert len(list(profile_path.glob("wanted-*.pstats"))) == 1
+
+
+def test_profiled_tasks_are_read_from_a_comma_separated_list(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("PROFILE_TASKS", "load_header, add_variance")
+    assert Settings().profile_tasks == ["load_header", "add_variance"]
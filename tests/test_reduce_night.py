@@ -0,0 +1,52 @@
+from datetime import date
+from datetime import datetime as dt
+from datetime import timezone as tz
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+from pipeline.config import ChannelReduction, NightReduction
+from pipeline.config.reduce_night import DEFAULT_MAX_WORKERS
+from pipeline.reduce_night import reduce_exposures
+from pipeline.resolver.resolver import Resolver
+
+
+def write_exposure(path: Path, value: float, with_variance: bool = True) -> Path:
+    data = np.full((6, 4), value, dtype=np.float32)
+    hdus = [fits.PrimaryHDU(), fits.ImageHDU(data)] + ([fits.ImageHDU(data)] if with_variance else [])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fits.HDUList(hdus).writeto(path)
+    return path
+
+
+def test_night_is_split_at_local_noon():
+    config = NightReduction(night=date(2025, 2, 25))
+    assert config.observation_time_range() == (dt(2025, 2, 25, 22, tzinfo=tz.utc), dt(2025, 2, 26, 22, tzinfo=tz.utc))
+    assert 1 <= config.max_workers == DEFAULT_MAX_WORKERS <= 4
+
+
+def test_process_pool_reports_each_exposure(tmp_path: Path):
+    run = tmp_path / "runs" / "run_id=25_001"
+    flats = [write_exposure(run / f"flat{i}.fits", i + 1) for i in range(2)]
+    good = write_exposure(run / "good.fits", 5)
+    # Without a variance HDU the reduction fails, which should only fail this exposure
+    bad = write_exposure(run / "bad.fits", 5, with_variance=False)
+    channel_configs = [
+        ChannelReduction(science_file=science_file, continuum_files=flats, use_cache=False)
+        for science_file in (good, bad)
+    ]
+    resolver = Resolver(
+        file_store_path=tmp_path / "filestore.parquet", data_path=tmp_path, output_path=tmp_path, read_only=True
+    )
+    config = NightReduction(run_ids=["25_001"], executor="process")
+
+    results = dict(reduce_exposures(config, channel_configs, resolver, max_workers=2))
+
+    assert results.keys() == {good, bad}
+    assert results[good] is None
+    assert isinstance(results[bad], AssertionError)
+    # Both exposures share the one master flat
+    assert len(list(resolver.master_calibration_path.glob("FLAT/*/master.npy"))) == 1
+    # Workers only read the filestore
+    assert not resolver.file_store_path.exists()
@@ -0,0 +1,148 @@
+from datetime import datetime as dt
+from datetime import timezone as tz
+from pathlib import Path
+
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from pipeline.resolver import FileStoreDataFrame, FileStoreIndex, Resolver
+from pipeline.resolver.common import file_records_to_frame
+
+TIME_ADDED = dt(2025, 2, 24, tzinfo=tz.utc)
+
+
+def make_file_store() -> FileStoreDataFrame:
+    records = [
+        {"file_path": "runs/run_id=25_001/a.fits", "type": "OBJECT", "run_id": "25_001", "channel": "B"},
+        {"file_path": "runs/run_id=25_001/b.fits", "type": "ARC", "run_id": "25_001", "channel": "B"},
+        {"file_path": "runs/run_id=25_002/c.fits", "type": "OBJECT", "run_id": "25_002", "channel": "R"},
+        {"file_path": "misc/type=WEATHER/d.parquet", "type": "WEATHER", "run_id": None, "channel": None},
+        {"file_path": "misc/type=RAW_LOGS/e.log", "type": "RAW_LOGS", "run_id": None, "channel": None},
+    ]
+    for record in records:
+        record |= {"file_name": Path(record["file_path"]).name, "time_added": TIME_ADDED}
+    return file_records_to_frame(records).pipe(FileStoreDataFrame)
+
+
+@pytest.fixture
+def resolver(tmp_path: Path) -> Resolver:
+    return Resolver(
+        file_store_path=tmp_path / "filestore",
+        data_path=tmp_path,
+        output_path=tmp_path / "output",
+        partition_file_store=True,
+    )
+
+
+def test_partitioned_file_store_round_trip(resolver: Resolver):
+    df = make_file_store()
+    resolver.save_filestore(df)
+
+    loaded = resolver.file_store.with_columns(pl.col("type").cast(pl.String)).sort("file_path")
+    expected = df.with_columns(pl.col("type").cast(pl.String)).sort("file_path")
+    assert_frame_equal(loaded, expected, check_column_order=False)
+
+    # Rows without a run_id are kept in the default partition, and read back with a null run_id
+    row = resolver.file_store_index.get_row("misc/type=WEATHER/d.parquet")
+    assert row is not None
+    assert row["type"] == "WEATHER"
+    assert row["run_id"] is None
+    assert resolver.file_store_index.get_row("missing.fits") is None
+
+
+def test_partitioned_lookups_match_index(resolver: Resolver):
+    df = make_file_store()
+    resolver.save_filestore(df)
+    scan = resolver.file_store_index
+    index = FileStoreIndex(df)
+
+    def normalise(frame: pl.DataFrame) -> pl.DataFrame:
+        return frame.with_columns(pl.col("type").cast(pl.String)).select(df.columns).sort("file_path")
+
+    file_paths = ["misc/type=RAW_LOGS/e.log", "runs/run_id=25_001/a.fits"]
+    assert_frame_equal(normalise(scan.get_rows(file_paths)), normalise(index.get_rows(file_paths)))
+    assert_frame_equal(normalise(scan.of_type("OBJECT")), normalise(index.of_type("OBJECT")))
+    assert_frame_equal(normalise(scan.of_group("ARC", "25_001", "B")), normalise(index.of_group("ARC", "25_001", "B")))
+    assert scan.of_group("WEATHER", None, None).is_empty()
+    with pytest.raises(FileNotFoundError):
+        scan.get_rows(["missing.fits"])
+
+
+def test_partitioned_file_store_deltas_and_compaction(resolver: Resolver):
+    resolver.save_filestore(make_file_store())
+    new_file = resolver.data_path / "misc" / "type=WEATHER" / "f.parquet"
+    new_file.parent.mkdir(parents=True)
+    new_file.write_bytes(b"weather")
+
+    resolver.ensure_file_exists(new_file)
+    assert len(resolver.list_file_store_deltas()) == 1
+    weather = resolver.scan_file_store(pl.col("type") == "WEATHER").collect()
+    assert sorted(weather["file_path"]) == ["misc/type=WEATHER/d.parquet", "misc/type=WEATHER/f.parquet"]
+    assert resolver.file_store_index.get_row("misc/type=WEATHER/f.parquet")["run_id"] is None
+
+    resolver.compact_filestore()
+    assert resolver.list_file_store_deltas() == []
+    assert len(resolver.file_store) == 6
+    assert resolver.find_science_files(run_ids=["25_002"]) == [resolver.data_path / "runs/run_id=25_002/c.fits"]
+
+
+def test_partitioned_file_store_is_swapped_in_whole(resolver: Resolver):
+    # A filestore from before versions were kept is a plain directory
+    make_file_store().with_columns(pl.col("type").cast(pl.String)).write_parquet(
+        resolver.file_store_path, partition_by=["type", "run_id"]
+    )
+    for _ in range(3):
+        resolver.save_filestore(make_file_store())
+
+    assert resolver.file_store_path.is_symlink()
+    # Only the current and previous versions are kept
+    assert len(list(resolver.file_store_versions_path.iterdir())) == 2
+    assert len(resolver.file_store) == 5
+
+
+def test_detector_last_on_times_are_looked_up_in_bulk(tmp_path: Path):
+    resolver = Resolver(file_store_path=tmp_path / "filestore.parquet", data_path=tmp_path, output_path=tmp_path)
+    on_times_path = "processed/type=CCD_ON_TIMES/times.parquet"
+    (tmp_path / on_times_path).parent.mkdir(parents=True)
+    pl.DataFrame(
+        {
+            "channel": ["B", "R", "B", "B"],
+            "time": [dt(2025, 2, 25, hour, tzinfo=tz.utc) for hour in (1, 2, 3, 3)],
+        },
+        schema_overrides={"time": pl.Datetime("ms", "UTC")},
+    ).write_parquet(tmp_path / on_times_path)
+
+    records = [
+        {"file_path": on_times_path, "type": "CCD_ON_TIMES", "run_id": None, "channel": None},
+        *[
+            {
+                "file_path": f"runs/run_id=25_001/{name}.fits",
+                "type": "OBJECT",
+                "run_id": "25_001",
+                "channel": channel,
+                "time_observation": dt(2025, 2, 25, hour, 30, tzinfo=tz.utc),
+            }
+            for name, channel, hour in [
+                ("late_b", "blue", 4),
+                ("early_b", "B", 0),
+                ("r", "R", 2),
+                ("same_night_b", "B", 3),
+            ]
+        ],
+    ]
+    for record in records:
+        record |= {"file_name": Path(record["file_path"]).name, "time_added": TIME_ADDED}
+    resolver.save_filestore(file_records_to_frame(records).pipe(FileStoreDataFrame))
+
+    science_files = [tmp_path / record["file_path"] for record in records[1:]]
+    last_on_times = resolver.get_detector_last_on_times(science_files)
+    # One row per science file in the order given, matched on the channel's first letter, with nothing earlier
+    # than the first exposure giving a null
+    assert last_on_times["science_file"].to_list() == [record["file_path"] for record in records[1:]]
+    assert last_on_times["detector_last_on_time"].to_list() == [
+        dt(2025, 2, 25, 3, tzinfo=tz.utc),
+        None,
+        dt(2025, 2, 25, 2, tzinfo=tz.utc),
+        dt(2025, 2, 25, 3, tzinfo=tz.utc),
+    ]
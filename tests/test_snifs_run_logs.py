@@ -0,0 +1,26 @@
+from datetime import datetime as dt
+from datetime import timezone as tz
+
+import polars as pl
+import pytest
+
+from pipeline.tasks.snifs_run_logs import CCD_ON_TIMES_SCHEMA, parse_run_log_events
+
+SAMPLE_LOG = b"""2025 SNIFS_on 1 0 B ==>Tue Feb 25 09:00:00 UTC 2025
+2025 some other line ==>Tue Feb 25 09:05:00 UTC 2025
+2025 SNIFS_on 1 1 R ==>Wed Feb  5 23:10:00 HST 2025 \n"""
+
+
+def test_parse_sample_log_lines():
+    df = parse_run_log_events(SAMPLE_LOG)
+    assert df.schema == pl.Schema(CCD_ON_TIMES_SCHEMA)
+    assert df.rows() == [
+        ("B", dt(2025, 2, 25, 9, 0, tzinfo=tz.utc)),
+        # Hawaii is ten hours behind UTC, which takes this past midnight
+        ("R", dt(2025, 2, 6, 9, 10, tzinfo=tz.utc)),
+    ]
+
+
+def test_unknown_time_zones_are_rejected():
+    with pytest.raises(pl.exceptions.InvalidOperationError):
+        parse_run_log_events(b"2025 SNIFS_on 1 0 B ==>Tue Feb 25 09:00:00 CET 2025\n")